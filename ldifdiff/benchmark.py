@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import base64
+import random
+import platform
+import argparse
+import resource
+import tempfile
+from os import SEEK_SET
+
+from ldifdiff import LDIFFile, LDIFDiff
+
+"""
+    LDIF Benchmark
+
+    Generates a deterministic pair of synthetic LDIF snapshots and measures
+    the parse, index and diff paths of ldifdiff against them.
+
+        python benchmark.py --entries 100000 --save results.json
+        python benchmark.py --entries 100000 --compare results.json
+"""
+
+FOLD_WIDTH = 76
+
+
+class CorpusSpec(object):
+
+    def __init__(self, entries=10000, attrs=10, multi_value=0.1, churn=0.05,
+                 folded=0.0, base64=0.0, seed=0):
+        self.entries = entries
+        self.attrs = attrs
+        self.multi_value = multi_value
+        self.churn = churn
+        self.folded = folded
+        self.base64 = base64
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class CorpusGenerator(object):
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def _value(self, rng, length=12):
+        return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789")
+                       for _ in range(length))
+
+    def _entry(self, rng, netid):
+
+        spec = self.spec
+        rec = [("dn", "uid={0},ou=people,o=example".format(netid)),
+               ("NETID", netid)]
+
+        for attr in range(spec.attrs):
+            count = 1
+            while rng.random() < spec.multi_value and count < 8:
+                count += 1
+            for _ in range(count):
+                rec.append(("attr{0}".format(attr), self._value(rng)))
+
+        return rec
+
+    def _mutate(self, rng, rec):
+
+        rec = list(rec)
+        pos = rng.randrange(2, len(rec)) if len(rec) > 2 else None
+
+        if pos is not None:
+            (key, _) = rec[pos]
+            rec[pos] = (key, self._value(rng))
+
+        return rec
+
+    def _write_line(self, fd, rng, key, value, plain=False):
+
+        spec = self.spec
+        line = "{0}: {1}".format(key, value)
+
+        if plain:
+            fd.write(line + "\n")
+            return
+
+        if spec.base64 and rng.random() < spec.base64:
+            encoded = base64.b64encode(value.encode('ascii'))
+            line = "{0}:: {1}".format(key, encoded.decode('ascii'))
+
+        if spec.folded and rng.random() < spec.folded:
+            # pad the value so that it actually needs folding
+            line += " " + self._value(rng, FOLD_WIDTH)
+            fd.write(line[:FOLD_WIDTH] + "\n")
+            line = line[FOLD_WIDTH:]
+            while line:
+                fd.write(" " + line[:FOLD_WIDTH - 1] + "\n")
+                line = line[FOLD_WIDTH - 1:]
+        else:
+            fd.write(line + "\n")
+
+    def _write_rec(self, fd, rng, rec):
+
+        # the primary key is never encoded or folded, LDIFFile indexes on it
+        for key, value in rec:
+            self._write_line(fd, rng, key, value, plain=(key == "NETID"))
+
+        fd.write("\n")
+
+    def _encoding(self, index, created=False):
+
+        # each record gets its own stream for the base64 and folding choices,
+        #  so it is encoded the same way in a and b whatever came before it
+        return random.Random(((self.spec.seed * 2 + created) << 32) + index)
+
+    def generate(self, path_a, path_b):
+
+        spec = self.spec
+        rng = random.Random(spec.seed)
+
+        # a separate stream drives the churn so that changing the churn rate
+        #  does not change the base corpus
+        churn = random.Random(spec.seed + 1)
+
+        with open(path_a, 'w') as fd_a, open(path_b, 'w') as fd_b:
+
+            for index in range(spec.entries):
+
+                rec = self._entry(rng, "u{0:08d}".format(index))
+                roll = churn.random()
+
+                self._write_rec(fd_a, self._encoding(index), rec)
+
+                if roll < spec.churn / 3.0:
+                    # deleted in b
+                    continue
+                elif roll < spec.churn * 2 / 3.0:
+                    rec = self._mutate(churn, rec)
+                elif roll < spec.churn:
+                    # created in b
+                    added = "n{0:08d}".format(index)
+                    self._write_rec(fd_b, self._encoding(index, created=True),
+                                    self._entry(churn, added))
+
+                self._write_rec(fd_b, self._encoding(index), rec)
+
+
+class CountingWriter(object):
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+
+    # ru_maxrss is kilobytes on linux and bytes on darwin; for
+    #  RUSAGE_CHILDREN it is the largest child that has been waited for
+    rss = resource.getrusage(who).ru_maxrss
+
+    if sys.platform == 'darwin':
+        rss //= 1024
+
+    return rss
+
+
+def run(path_a, path_b, pipelined=False):
+
+    results = dict()
+    size = os.path.getsize(path_a)
+
+    start = time.time()
+    ldif = LDIFFile(path_a)
+    elapsed = time.time() - start
+
+    results['index_seconds'] = elapsed
+    results['index_records'] = len(ldif.int_index)
+    results['index_peak_rss_kb'] = peak_rss()
+
+    ldif.fd.seek(0, SEEK_SET)
+    count = 0
+    start = time.time()
+    for _ in ldif:
+        count += 1
+    elapsed = time.time() - start
+
+    results['parse_seconds'] = elapsed
+    results['parse_records_per_sec'] = count / elapsed if elapsed else 0.0
+    results['parse_mb_per_sec'] = size / elapsed / 2**20 if elapsed else 0.0
+
+    start = time.time()
+    ldd = LDIFDiff(path_a, path_b, pipelined=pipelined)
+    results['diff_index_seconds'] = time.time() - start
+
+    out = CountingWriter()
+    start = time.time()
+    try:
+        ldd.write(out, pipelined=pipelined)
+    finally:
+        ldd.close()
+    elapsed = time.time() - start
+
+    (_, _, deltas) = ldd.stats.stages["read+diff" if pipelined else "diff"]
+
+    results['diff_seconds'] = elapsed
+    results['diff_deltas'] = deltas
+    results['output_bytes'] = out.bytes
+    results['output_mb_per_sec'] = out.bytes / elapsed / 2**20 if elapsed else 0.0
+    # with --pipeline most of the work happens in child processes
+    children = peak_rss(resource.RUSAGE_CHILDREN)
+    results['peak_rss_self_kb'] = peak_rss()
+    results['peak_rss_children_kb'] = children
+    results['peak_rss_kb'] = max(results['peak_rss_self_kb'], children)
+    results['stages'] = dict((stage, {'busy': busy, 'wait': wait,
+                                      'items': items})
+                             for stage, (busy, wait, items)
+                             in ldd.stats.stages.items())
+
+    return results
+
+
+def compare(old, new, out=None):
+
+    if out is None:
+        out = sys.stdout
+
+    out.write("{0:<24} {1:>12} {2:>12} {3:>8}\n".format(
+        "METRIC", "OLD", "NEW", "RATIO"))
+
+    for key in sorted(new['results']):
+        a = old['results'].get(key)
+        b = new['results'][key]
+        if not isinstance(b, (int, float)) or not isinstance(a, (int, float)):
+            continue
+        ratio = b / float(a) if a else float('nan')
+        out.write("{0:<24} {1:>12.3f} {2:>12.3f} {3:>8.2f}\n".format(
+            key, a, b, ratio))
+
+
+_DESCRIPTION = """LDIF Benchmark
+    Generate a synthetic LDIF corpus and time ldifdiff against it.
+"""
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog="benchmark.py",
+                                     description=_DESCRIPTION)
+    parser.add_argument("--entries", "-n", type=int, default=10000)
+    parser.add_argument("--attrs", type=int, default=10,
+                        help="attributes per entry (besides dn and NETID)")
+    parser.add_argument("--multi-value", type=float, default=0.1,
+                        help="chance of each additional value per attribute")
+    parser.add_argument("--churn", type=float, default=0.05,
+                        help="fraction of entries deleted/modified/created")
+    parser.add_argument("--folded", type=float, default=0.0,
+                        help="fraction of lines folded at {0} columns".format(
+                            FOLD_WIDTH))
+    parser.add_argument("--base64", type=float, default=0.0,
+                        help="fraction of values written as 'attr:: base64'")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pipeline", "-p", action="store_true")
+    parser.add_argument("--workdir", "-w",
+                        help="where to keep the corpus (default: temp dir)")
+    parser.add_argument("--save", "-s", help="write JSON results here")
+    parser.add_argument("--compare", "-c",
+                        help="compare against previously saved results")
+
+    args = parser.parse_args()
+
+    spec = CorpusSpec(entries=args.entries, attrs=args.attrs,
+                      multi_value=args.multi_value, churn=args.churn,
+                      folded=args.folded, base64=args.base64, seed=args.seed)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ldifbench")
+    name = "corpus-{entries}-{attrs}-{seed}".format(**spec.to_dict())
+    path_a = os.path.join(workdir, name + "-a.ldif")
+    path_b = os.path.join(workdir, name + "-b.ldif")
+
+    start = time.time()
+    CorpusGenerator(spec).generate(path_a, path_b)
+    sys.stderr.write("generated {0} entries in {1:.3f}s\n".format(
+        spec.entries, time.time() - start))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pipelined': args.pipeline,
+        'spec': spec.to_dict(),
+        'results': run(path_a, path_b, pipelined=args.pipeline),
+    }
+
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(json.load(fd), report)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+
+    if not args.workdir:
+        os.remove(path_a)
+        os.remove(path_b)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,20 @@
 #!/usr/bin/python
 
 import io
+import os
 import re
 import sys
+import time
+import shutil
+import signal
+import pickle
 import argparse
+import tempfile
+import threading
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
 from os import SEEK_SET, SEEK_END
 from mmap import mmap, PROT_READ
 
@@ -33,15 +44,108 @@ DEBUG = False
 """
 
 
+class AttributeIndex(object):
+
+    """
+        Inverted index of attribute value -> record offsets.
+
+        Values are kept sorted so exact and prefix lookups are a bisect;
+        offsets are stored in CSR layout (the offsets for keys[i] are
+        offsets[starts[i]:starts[i + 1]]) in flat arrays rather than a list
+        per value.
+    """
+
+    def __init__(self, values=None):
+
+        self.keys = list()
+        self.starts = array('L', [0])
+        self.offsets = array('L')
+        self._suffixes = None
+
+        if values:
+            for key in sorted(values):
+                self.keys.append(key)
+                self.offsets.extend(values[key])
+                self.starts.append(len(self.offsets))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        return (self.keys, self.starts, self.offsets)
+
+    def __setstate__(self, state):
+        (self.keys, self.starts, self.offsets) = state
+        self._suffixes = None
+
+    def _slice(self, pos):
+        return self.offsets[self.starts[pos]:self.starts[pos + 1]]
+
+    def _prefix_range(self, keys, prefix):
+
+        lo = bisect_left(keys, prefix)
+        hi = lo
+
+        while hi < len(keys) and keys[hi].startswith(prefix):
+            hi += 1
+
+        return (lo, hi)
+
+    def exact(self, value):
+
+        pos = bisect_left(self.keys, value)
+
+        if pos < len(self.keys) and self.keys[pos] == value:
+            return list(self._slice(pos))
+
+        return list()
+
+    def prefix(self, prefix):
+
+        found = set()
+        (lo, hi) = self._prefix_range(self.keys, prefix)
+
+        for pos in range(lo, hi):
+            found.update(self._slice(pos))
+
+        return sorted(found)
+
+    def suffix(self, suffix):
+
+        # reversed keys are only built for the first suffix query
+        if self._suffixes is None:
+            pairs = sorted((key[::-1], pos) for pos, key in enumerate(self.keys))
+            self._suffixes = ([key for key, _ in pairs],
+                              array('L', [pos for _, pos in pairs]))
+
+        (keys, positions) = self._suffixes
+        found = set()
+        (lo, hi) = self._prefix_range(keys, suffix[::-1])
+
+        for pos in range(lo, hi):
+            found.update(self._slice(positions[pos]))
+
+        return sorted(found)
+
+
 class LDIFFile(object):
 
     PKEY_ERROR_STR = "Unable to determine a Primary Key."
     PKEY_DUP_ERROR_STR = "The Primary Key must be unique for all recs."
+    INDEX_ERROR_STR = "The attribute {0} is not indexed."
     RE_END = re.compile(r"^\s*$")
 
+    INDEX_VERSION = 2
+
+    MATCH_EXACT = 'exact'
+    MATCH_PREFIX = 'prefix'
+    MATCH_SUFFIX = 'suffix'
+
     def __init__(self, path, pkey=None, case_sensitive=False,
-                 use_mmap=True, encoding=None):
+                 use_mmap=True, encoding=None, index_attrs=None,
+                 index_path=None, indexed=True):
 
+        self.path = path
         self.fd = io.open(path, 'r')
 
         if use_mmap:
@@ -64,8 +168,27 @@ class LDIFFile(object):
 
         self.pkey = pkey
 
+        if index_attrs is None:
+            index_attrs = list()
+        if not case_sensitive:
+            index_attrs = [attr.upper() for attr in index_attrs]
+        self.index_attrs = list(index_attrs)
+
+        # without an index records can still be read by offset
+        if not indexed:
+            self.str_index = dict()
+            self.int_index = list()
+            self.attr_index = dict()
+            return
+
+        if index_path is not None and self.load_index(index_path):
+            return
+
         self.create_index(self.pkey)
 
+        if index_path is not None:
+            self.save_index(index_path)
+
     def __getitem__(self, value):
 
         rec = None
@@ -78,6 +201,17 @@ class LDIFFile(object):
 
         return rec
 
+    def read_at(self, offset):
+
+        hold = self.fd.tell()
+
+        self.fd.seek(offset, SEEK_SET)
+
+        rec = self.read_rec()
+        self.fd.seek(hold, SEEK_SET)
+
+        return rec
+
     def __iter__(self):
 
         if self._iter_hold is None:
@@ -196,6 +330,8 @@ class LDIFFile(object):
         self.str_index = dict({})
         self.int_index = list()
 
+        attr_values = dict((attr, dict()) for attr in self.index_attrs)
+
         for rec in self:
 
             tag = list(rec[self.pkey])[0]
@@ -208,8 +344,79 @@ class LDIFFile(object):
             self.str_index[tag] = offset
             self.int_index.append(offset)
 
+            for attr, values in attr_values.items():
+                for value in rec.get(attr, ()):
+                    if not self.case_sensitive:
+                        value = value.lower()
+                    if value not in values:
+                        values[value] = [offset]
+                    elif values[value][-1] != offset:
+                        # values differing only in case fold to one key
+                        values[value].append(offset)
+
             offset = self.fd.tell()
 
+        self.attr_index = dict((attr, AttributeIndex(values))
+                               for attr, values in attr_values.items())
+
+    def _index_header(self):
+
+        stat = os.stat(self.path)
+
+        return (LDIFFile.INDEX_VERSION, self._file_size, stat.st_mtime,
+                self.pkey, self.case_sensitive, sorted(self.index_attrs))
+
+    def save_index(self, path):
+
+        with open(path, 'wb') as fd:
+            pickle.dump(self._index_header(), fd, 2)
+            pickle.dump((self.str_index, array('L', self.int_index),
+                         self.attr_index), fd, 2)
+
+    def load_index(self, path):
+
+        # a missing or stale index is not an error, it is rebuilt instead
+        try:
+            with open(path, 'rb') as fd:
+                if pickle.load(fd) != self._index_header():
+                    return False
+                (self.str_index, int_index, self.attr_index) = pickle.load(fd)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+        self.int_index = list(int_index)
+
+        return True
+
+    def offsets(self, attr, value, match=MATCH_EXACT):
+
+        if not self.case_sensitive:
+            attr = attr.upper()
+            value = value.lower()
+
+        if attr not in self.attr_index:
+            raise KeyError(LDIFFile.INDEX_ERROR_STR.format(attr))
+
+        index = self.attr_index[attr]
+
+        if match == LDIFFile.MATCH_PREFIX:
+            return index.prefix(value)
+        elif match == LDIFFile.MATCH_SUFFIX:
+            return index.suffix(value)
+
+        return index.exact(value)
+
+    def find(self, attr, value, match=MATCH_EXACT):
+
+        for offset in self.offsets(attr, value, match):
+            yield self.read_at(offset)
+
+    def find_prefix(self, attr, prefix):
+        return self.find(attr, prefix, match=LDIFFile.MATCH_PREFIX)
+
+    def find_suffix(self, attr, suffix):
+        return self.find(attr, suffix, match=LDIFFile.MATCH_SUFFIX)
+
 """
 
     ldif rec diff
@@ -231,10 +438,35 @@ class LDIFDiff(object):
     DIFF_MOD = '~'
 
     def __init__(self, path_a, path_b, memory_map=True,
-                 exclude=None, include=None, case_sensitive=False):
-
-        self.a = LDIFFile(path_a)
-        self.b = LDIFFile(path_b)
+                 exclude=None, include=None, case_sensitive=False,
+                 pipelined=False, index_paths=(None, None), indexed=True):
+
+        self.paths = (path_a, path_b)
+        self.index_paths = tuple(index_paths)
+        self.stats = PipelineStats()
+        self._workdir = None
+
+        if not indexed:
+            # pipeline workers only read the records at offsets they are sent
+            self.a = LDIFFile(path_a, indexed=False)
+            self.b = LDIFFile(path_b, indexed=False)
+        elif pipelined:
+            # index both inputs at the same time in separate processes
+            if None in self.index_paths:
+                self.index_paths = self._temp_index_paths()
+            try:
+                self.a, self.b = open_concurrently(path_a, path_b, self.stats,
+                                                   self.index_paths)
+            except BaseException:
+                self.close()
+                raise
+        else:
+            with self.stats.timer("index:a") as timer:
+                self.a = LDIFFile(path_a, index_path=self.index_paths[0])
+                timer.items = len(self.a.int_index)
+            with self.stats.timer("index:b") as timer:
+                self.b = LDIFFile(path_b, index_path=self.index_paths[1])
+                timer.items = len(self.b.int_index)
 
         if self.a.pkey != self.b.pkey:
             return None
@@ -252,7 +484,33 @@ class LDIFDiff(object):
             include = list()
         self.include = include
 
-    def print_delta(self, delta, changes_only=True):
+    def _temp_index_paths(self):
+
+        self._workdir = tempfile.mkdtemp(prefix="ldifdiff")
+
+        return (os.path.join(self._workdir, "a.index"),
+                os.path.join(self._workdir, "b.index"))
+
+    def worker_config(self):
+
+        # workers open the files without an index, records are read at the
+        #  offsets shipped with each batch
+        options = dict(exclude=self.exclude, include=self.include,
+                       case_sensitive=self.case_sensitive, indexed=False)
+
+        return (self.paths, options)
+
+    def close(self):
+
+        # only indexes saved to a temporary directory are removed
+        if self._workdir is not None:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+            self._workdir = None
+
+    def print_delta(self, delta, changes_only=True, out=None):
+
+        if out is None:
+            out = sys.stdout
 
         ((op, pkey, pkey_value), diff) = delta
         temp = io.BytesIO()
@@ -266,10 +524,10 @@ class LDIFDiff(object):
                 temp.write("{0} {1}: {2}\n".format(op, key, value))
 
         if temp.tell():
-            sys.stdout.write("{0}: {1}\n".format(pkey, pkey_value))
+            out.write("{0}: {1}\n".format(pkey, pkey_value))
             temp.seek(0, SEEK_SET)
-            sys.stdout.write(temp.read())
-            sys.stdout.write("\n")
+            out.write(temp.read())
+            out.write("\n")
 
         temp.close()
 
@@ -363,31 +621,290 @@ class LDIFDiff(object):
 
         return diff
 
-    def diff(self):
+    def pairs(self):
 
-        global DEBUG
         # collect all of the pkey values in both LDIFFiles
         a_keys = set(self.a.str_index.keys())
         b_keys = set(self.b.str_index.keys())
 
         # intersection gives us keys in both sets (modify)
         for index in a_keys.intersection(b_keys):
-            a_rec = self.a[index]
-            b_rec = self.b[index]
-            diff = self.diff_record(a_rec, b_rec)
-            yield ((LDIFDiff.DIFF_MOD, self.pkey, index), diff)
+            yield (LDIFDiff.DIFF_MOD, index)
 
         # difference b-a = keys in 'b' but not in 'a' (create)
         for index in b_keys.difference(a_keys):
-            b_rec = self.b[index]
-            diff = self.diff_record({}, b_rec)
-            yield ((LDIFDiff.DIFF_ADD, self.pkey, index), diff)
+            yield (LDIFDiff.DIFF_ADD, index)
 
         # difference a-b = keys in 'a' but not in 'b' (delete)
         for index in a_keys.difference(b_keys):
-            a_rec = self.a[index]
-            diff = self.diff_record(a_rec, {})
-            yield ((LDIFDiff.DIFF_DEL, self.pkey, index), diff)
+            yield (LDIFDiff.DIFF_DEL, index)
+
+    def pair_offsets(self, op, index):
+
+        a_offset = None if op == LDIFDiff.DIFF_ADD else self.a.str_index[index]
+        b_offset = None if op == LDIFDiff.DIFF_DEL else self.b.str_index[index]
+
+        return (a_offset, b_offset)
+
+    def read_offsets(self, a_offset, b_offset):
+
+        a_rec = {} if a_offset is None else self.a.read_at(a_offset)
+        b_rec = {} if b_offset is None else self.b.read_at(b_offset)
+
+        return (a_rec, b_rec)
+
+    def read_pair(self, op, index):
+        return self.read_offsets(*self.pair_offsets(op, index))
+
+    def diff(self):
+
+        global DEBUG
+
+        for op, index in self.pairs():
+            a_rec, b_rec = self.read_pair(op, index)
+            diff = self.diff_record(a_rec, b_rec)
+            yield ((op, self.pkey, index), diff)
+
+    def diff_pipelined(self, batch_size=1024, workers=None, window=None):
+
+        pipeline = LDIFPipeline(self, batch_size=batch_size, workers=workers,
+                                window=window)
+
+        return pipeline.deltas()
+
+    def write(self, out=None, changes_only=True, pipelined=False,
+              batch_size=1024, workers=None, window=None):
+
+        if pipelined:
+            pipeline = LDIFPipeline(self, batch_size=batch_size,
+                                    workers=workers, window=window)
+            pipeline.write(out, changes_only=changes_only)
+            return
+
+        with self.stats.timer("diff") as timer:
+            for delta in self.diff():
+                self.print_delta(delta, changes_only=changes_only, out=out)
+                timer.items += 1
+
+
+"""
+    Pipelined diff
+
+    index:a (process) --+
+                        +--> read+diff (worker pool) --> write
+    index:b (process) --+
+
+    Reading and diffing records is CPU bound Python, so the stages run in
+    processes rather than threads; under the GIL threads only take turns and
+    a page fault on the mmap stalls all of them. Each input is indexed in its
+    own process and the index is saved for the parent to load. The parent
+    then sends batches of (pkey, offset in a, offset in b) to a pool of
+    workers that hold no index, only the mapped files; they parse and diff
+    the records while at most `window` batches (2 per worker by default) are
+    in flight, and the parent writes the results in order.
+
+    The mode stays opt-in because it only pays off with a core per worker.
+    On a one core machine with a 30k entry corpus (benchmark.py -n 30000),
+    the pipeline took 9.5s end to end against 7 to 9s sequentially.
+"""
+
+
+class StageTimer(object):
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+        self.items = 0
+        self.wait = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        self.stats.add(self.stage, busy=elapsed - self.wait, wait=self.wait,
+                       items=self.items)
+        return False
+
+
+class PipelineStats(object):
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def add(self, stage, busy=0.0, wait=0.0, items=0):
+
+        with self._lock:
+            (b, w, i) = self.stages.get(stage, (0.0, 0.0, 0))
+            self.stages[stage] = (b + busy, w + wait, i + items)
+
+    def report(self, out=None):
+
+        if out is None:
+            out = sys.stderr
+
+        out.write("{0:<12} {1:>10} {2:>10} {3:>10}\n".format(
+            "STAGE", "ITEMS", "BUSY(s)", "WAIT(s)"))
+
+        for stage, (busy, wait, items) in self.stages.items():
+            out.write("{0:<12} {1:>10} {2:>10.3f} {3:>10.3f}\n".format(
+                stage, items, busy, wait))
+
+        out.write("{0:<12} {1:>10} {2:>10.3f}\n".format(
+            "wall", "", time.time() - self._start))
+
+
+def _index_file(path, index_path):
+    LDIFFile(path, index_path=index_path)
+
+
+def open_concurrently(path_a, path_b, stats, index_paths):
+
+    started = list()
+
+    for name, path, index_path in zip("ab", (path_a, path_b), index_paths):
+        proc = multiprocessing.Process(target=_index_file,
+                                       args=(path, index_path))
+        proc.start()
+        started.append((name, path, index_path, proc, time.time()))
+
+    files = dict()
+
+    try:
+        for name, path, index_path, proc, start in started:
+            proc.join()
+            # a failed child leaves no index behind, so the file is indexed
+            #  again here and the error is raised in this process
+            files[name] = LDIFFile(path, index_path=index_path)
+            stats.add("index:" + name, busy=time.time() - start,
+                      items=len(files[name].int_index))
+    finally:
+        for (_, _, _, proc, _) in started:
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+
+    return (files["a"], files["b"])
+
+
+# the LDIFDiff of a pool worker, it has no index of its own
+_worker_ldd = None
+
+
+def _init_worker(config):
+
+    global _worker_ldd
+
+    # Ctrl-C is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    (paths, options) = config
+    _worker_ldd = LDIFDiff(paths[0], paths[1], **options)
+
+
+def _diff_batch(batch, changes_only):
+
+    start = time.time()
+    ldd = _worker_ldd
+    deltas = list()
+
+    for op, index, a_offset, b_offset in batch:
+        a_rec, b_rec = ldd.read_offsets(a_offset, b_offset)
+        deltas.append(((op, ldd.pkey, index), ldd.diff_record(a_rec, b_rec)))
+
+    # when writing, the text is rendered here rather than shipping the deltas
+    if changes_only is not None:
+        out = io.BytesIO()
+        for delta in deltas:
+            ldd.print_delta(delta, changes_only=changes_only, out=out)
+        deltas = out.getvalue()
+
+    return (deltas, len(batch), time.time() - start)
+
+
+class LDIFPipeline(object):
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, ldd, batch_size=1024, workers=None, window=None):
+        self.ldd = ldd
+        self.stats = ldd.stats
+        self.batch_size = batch_size
+        self.workers = workers or multiprocessing.cpu_count()
+        # batches in flight at once, which bounds the memory in use
+        self.window = window or 2 * self.workers
+
+    def _batches(self):
+
+        batch = list()
+
+        for op, index in self.ldd.pairs():
+            batch.append((op, index) + self.ldd.pair_offsets(op, index))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = list()
+
+        if batch:
+            yield batch
+
+    def _collect(self, timer, result):
+
+        start = time.time()
+
+        # wait with a timeout so that KeyboardInterrupt is still delivered
+        while True:
+            try:
+                (deltas, items, busy) = result.get(LDIFPipeline.POLL_INTERVAL)
+                break
+            except multiprocessing.TimeoutError:
+                continue
+
+        timer.wait += time.time() - start
+        timer.items += items
+        self.stats.add("read+diff", busy=busy, items=items)
+
+        return deltas
+
+    def _run(self, timer, changes_only=None):
+
+        pool = multiprocessing.Pool(self.workers, _init_worker,
+                                    (self.ldd.worker_config(),))
+        pending = deque()
+
+        try:
+            for batch in self._batches():
+                pending.append(pool.apply_async(_diff_batch,
+                                                (batch, changes_only)))
+                while len(pending) >= self.window:
+                    yield self._collect(timer, pending.popleft())
+
+            while pending:
+                yield self._collect(timer, pending.popleft())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def deltas(self):
+
+        with self.stats.timer("write") as timer:
+            for deltas in self._run(timer):
+                for delta in deltas:
+                    yield delta
+
+    def write(self, out=None, changes_only=True):
+
+        if out is None:
+            out = sys.stdout
+
+        with self.stats.timer("write") as timer:
+            for text in self._run(timer, changes_only=changes_only):
+                out.write(text)
 
 
 _DESCRIPTION = """LDIFDiff
@@ -407,11 +924,34 @@ def main():
     parser.add_argument("--verbose", "-v", action="store_true", dest="verbose")
     parser.add_argument("--exclude", "-e", nargs="+")
     parser.add_argument("--include", "-i", nargs="+")
+    parser.add_argument("--pipeline", "-p", action="store_true",
+                        help="index and diff in worker processes")
+    parser.add_argument("--batch-size", type=int, default=1024,
+                        help="records per batch handed to a worker")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per cpu)")
+    parser.add_argument("--window", type=int, default=None,
+                        help="batches in flight (default: 2 per worker)")
+    parser.add_argument("--stats", action="store_true",
+                        help="print a stage by stage time breakdown")
 
     args = parser.parse_args()
-    print args
 
-    ldd = LDIFDiff()
+    if args.verbose:
+        sys.stderr.write("{0}\n".format(args))
+
+    ldd = LDIFDiff(args.x, args.y, exclude=args.exclude,
+                   include=args.include, pipelined=args.pipeline)
+
+    try:
+        ldd.write(sys.stdout, pipelined=args.pipeline,
+                  batch_size=args.batch_size, workers=args.workers,
+                  window=args.window)
+    finally:
+        ldd.close()
+
+    if args.stats:
+        ldd.stats.report(sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+import os
+import re
+import time
+import pickle
+import hashlib
+
+from export import type_name
+from connection import is_read_only
+
+"""
+    Client Side Result Cache
+
+    Complete query results are pickled into ~/.osql/cache keyed by the
+    connection, the normalized SQL and its bind values. Entries expire after
+    a TTL and the least recently used ones are evicted once the directory
+    grows past its size bound; a hit touches the file so its mtime doubles as
+    the LRU clock.
+"""
+
+CACHE_DIR = os.path.join(os.environ.get('HOME', '.'), '.osql', 'cache')
+
+DEFAULT_MAX_BYTES = 256 * 2**20
+DEFAULT_TTL = 60 * 60
+
+# results bigger than this are not kept for \sp or the cache
+MAX_RECORDED_ROWS = 100000
+
+# string literals and quoted identifiers are kept exactly as written
+RE_LITERAL = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+RE_SPACE = re.compile(r"\s+")
+
+
+def normalize(sql):
+
+    """
+        Collapse whitespace and case outside of string literals and quoted
+        identifiers and drop the trailing semicolon, so trivially different
+        spellings share an entry.
+    """
+
+    parts = RE_LITERAL.split(sql.strip().rstrip(';').strip())
+
+    for pos in range(0, len(parts), 2):
+        parts[pos] = RE_SPACE.sub(' ', parts[pos]).upper()
+
+    return ''.join(parts).strip()
+
+
+def is_cacheable(sql):
+    return is_read_only(sql)
+
+
+class CachedCursor(object):
+
+    """
+        Read-only DB-API cursor over a stored result so cached results can go
+        through the same display and export code as live ones.
+    """
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = rows
+        self.rowcount = len(rows)
+        self.arraysize = 10000
+        self._pos = 0
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                break
+            yield row
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        rows = self.rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows) - self._pos)
+
+    def rewind(self):
+        self._pos = 0
+        return self
+
+
+class RecordingCursor(object):
+
+    """
+        Cursor proxy that keeps a copy of the rows fetched through it, up to
+        max_rows; past that the recording is abandoned.
+    """
+
+    def __init__(self, cursor, max_rows=MAX_RECORDED_ROWS):
+        self._cursor = cursor
+        self.max_rows = max_rows
+        self.rows = list()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _record(self, rows):
+
+        if self.rows is None:
+            return
+
+        if len(self.rows) + len(rows) > self.max_rows:
+            self.rows = None
+        else:
+            self.rows.extend(rows)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            rows = self._cursor.fetchmany()
+        else:
+            rows = self._cursor.fetchmany(size)
+        self._record(rows)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._record([row])
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._record(rows)
+        return rows
+
+    def result(self):
+
+        """
+            The recorded result as a CachedCursor, or None when it was too
+            large to keep.
+        """
+
+        if self.rows is None:
+            return None
+
+        description = list((desc[0], type_name(desc[1])) + tuple(desc[2:])
+                           for desc in self._cursor.description)
+
+        return CachedCursor(description, [tuple(row) for row in self.rows])
+
+
+class ResultCache(object):
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES,
+                 ttl=DEFAULT_TTL, namespace=''):
+        self.directory = directory if directory is not None else CACHE_DIR
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # the connection identity, the same SQL on another database differs
+        self.namespace = namespace
+
+    def _path(self, sql, params=None):
+
+        key = self.namespace + "\n" + normalize(sql)
+        if params:
+            key += repr(sorted(params.items()) if isinstance(params, dict)
+                        else list(params))
+
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.directory, digest + '.pickle')
+
+    def get(self, sql, params=None):
+
+        path = self._path(sql, params)
+
+        try:
+            with open(path, 'rb') as fd:
+                (expires, description, rows) = pickle.load(fd)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+
+        if expires is not None and expires < time.time():
+            self._remove(path)
+            return None
+
+        # a hit makes this the most recently used entry
+        os.utime(path, None)
+
+        return CachedCursor(description, rows)
+
+    def put(self, sql, result, params=None, ttl=None):
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if ttl is None:
+            ttl = self.ttl
+
+        expires = time.time() + ttl if ttl else None
+        path = self._path(sql, params)
+        temp = "{0}.{1}.tmp".format(path, os.getpid())
+
+        try:
+            with open(temp, 'wb') as fd:
+                pickle.dump((expires, result.description, result.rows), fd, 2)
+        except Exception:
+            self._remove(temp)
+            raise
+
+        os.rename(temp, path)
+
+        self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+
+        entries = list()
+
+        if not os.path.isdir(self.directory):
+            return entries
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pickle'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for (_, size, _) in self._entries())
+
+    def evict(self):
+
+        entries = self._entries()
+        total = sum(size for (_, size, _) in entries)
+
+        # oldest first, until the cache fits again
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+
+        for (_, _, path) in self._entries():
+            self._remove(path)
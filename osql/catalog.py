@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+from export import type_name
+
+"""
+    Schema Catalog Cache
+
+    Table and view names, their columns and describe() results are cached on
+    disk in ~/.osql, one file per connection plus a small one for the
+    describe() results so a describe does not rewrite the whole catalog. The
+    cache is loaded at start up and refreshed in the background; after the
+    first full scan only objects whose LAST_DDL_TIME moved are fetched again.
+"""
+
+CACHE_DIR = os.path.join(os.environ.get('HOME', '.'), '.osql', 'catalog')
+
+# incremental refreshes cannot see dropped objects, so rescan now and then
+FULL_REFRESH_AGE = 24 * 60 * 60
+
+DATE_FORMAT = 'YYYY-MM-DD HH24:MI:SS'
+
+TYPE_TABLE = 'TABLE'
+TYPE_VIEW = 'VIEW'
+
+SQL_NOW = "SELECT TO_CHAR(SYSDATE, '{0}') FROM DUAL".format(DATE_FORMAT)
+
+SQL_OBJECTS = """SELECT OWNER, OBJECT_NAME, OBJECT_TYPE
+    FROM ALL_OBJECTS WHERE OBJECT_TYPE IN ('TABLE', 'VIEW')"""
+
+SQL_COLUMNS = """SELECT OWNER, TABLE_NAME, COLUMN_NAME
+    FROM ALL_TAB_COLUMNS"""
+
+SQL_CHANGED = " AND LAST_DDL_TIME >= TO_DATE(:since, '{0}')".format(
+    DATE_FORMAT)
+
+SQL_COLUMNS_CHANGED = """ WHERE (OWNER, TABLE_NAME) IN (
+    SELECT OWNER, OBJECT_NAME FROM ALL_OBJECTS
+    WHERE LAST_DDL_TIME >= TO_DATE(:since, '{0}'))""".format(DATE_FORMAT)
+
+
+def cache_path(key, directory=None, suffix=".json"):
+
+    if directory is None:
+        directory = CACHE_DIR
+
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    return os.path.join(directory, digest + suffix)
+
+
+def _write_json(path, state):
+
+    # a unique temp file then a rename, so neither a reader nor a concurrent
+    #  writer ever sees half a file
+    (fd, temp) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'w') as out:
+            json.dump(state, out)
+        os.rename(temp, path)
+    except Exception:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+class Catalog(object):
+
+    def __init__(self, key, directory=None):
+
+        self.path = cache_path(key, directory)
+        self.descriptions_path = cache_path(key, directory, ".describe.json")
+
+        # "OWNER.NAME" -> [owner, name, type]
+        self.objects = dict()
+        # "OWNER.NAME" -> [column, ...]
+        self.columns = dict()
+        # "NAME" as typed at describe -> cursor.description
+        self.descriptions = dict()
+
+        self.refreshed = None
+        self.full_refreshed = 0
+
+        self.listeners = list()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # saves are written in turn so an older state never lands last
+        self._save_lock = threading.Lock()
+
+    def load(self):
+
+        try:
+            with open(self.path) as fd:
+                state = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return False
+
+        try:
+            with open(self.descriptions_path) as fd:
+                descriptions = json.load(fd)
+        except (IOError, OSError, ValueError):
+            descriptions = dict()
+
+        with self._lock:
+            self.objects = state.get('objects', {})
+            self.columns = state.get('columns', {})
+            self.descriptions = descriptions
+            self.refreshed = state.get('refreshed')
+            self.full_refreshed = state.get('full_refreshed', 0)
+
+        return True
+
+    def _ensure_directory(self):
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def save(self):
+
+        self._ensure_directory()
+
+        with self._save_lock:
+            # refreshes replace values rather than change them in place, so
+            #  shallow copies are a consistent snapshot to write unlocked
+            with self._lock:
+                state = {
+                    'objects': dict(self.objects),
+                    'columns': dict(self.columns),
+                    'refreshed': self.refreshed,
+                    'full_refreshed': self.full_refreshed,
+                }
+                descriptions = dict(self.descriptions)
+
+            _write_json(self.path, state)
+            _write_json(self.descriptions_path, descriptions)
+
+    def save_descriptions(self):
+
+        self._ensure_directory()
+
+        with self._save_lock:
+            with self._lock:
+                descriptions = dict(self.descriptions)
+
+            _write_json(self.descriptions_path, descriptions)
+
+    def is_loaded(self):
+        return self.refreshed is not None
+
+    def refresh(self, cursor, full=None):
+
+        """
+            Bring the catalog up to date using `cursor`. Only objects changed
+            since the last refresh are fetched unless a full scan is due.
+        """
+
+        with self._refresh_lock:
+
+            if full is None:
+                full = (self.refreshed is None or
+                        time.time() - self.full_refreshed > FULL_REFRESH_AGE)
+
+            cursor.execute(SQL_NOW)
+            (now, ) = cursor.fetchone()
+
+            if full:
+                cursor.execute(SQL_OBJECTS)
+            else:
+                cursor.execute(SQL_OBJECTS + SQL_CHANGED,
+                               {'since': self.refreshed})
+            objects = dict(("{0}.{1}".format(owner, name), [owner, name, kind])
+                           for (owner, name, kind) in cursor)
+
+            if full:
+                cursor.execute(SQL_COLUMNS)
+            else:
+                cursor.execute(SQL_COLUMNS + SQL_COLUMNS_CHANGED,
+                               {'since': self.refreshed})
+            columns = dict()
+            for (owner, name, column) in cursor:
+                columns.setdefault("{0}.{1}".format(owner, name), []).append(
+                    column)
+
+            with self._lock:
+                if full:
+                    self.objects = objects
+                    self.columns = columns
+                    self.descriptions = dict()
+                    self.full_refreshed = time.time()
+                else:
+                    self.objects.update(objects)
+                    self.columns.update(columns)
+                    # anything describing a changed object may be stale
+                    changed = set(name for (_, name, _) in objects.values())
+                    changed.update(objects)
+                    for relation in list(self.descriptions):
+                        if relation.upper() in changed:
+                            del self.descriptions[relation]
+                self.refreshed = now
+
+        self.save()
+
+        for listener in self.listeners:
+            listener(self)
+
+    def refresh_in_background(self, connect):
+
+        """
+            Refresh on a connection from `connect`; the connection is closed
+            (returned to its pool) once the refresh is done.
+        """
+
+        def run():
+            try:
+                conn = connect()
+                try:
+                    self.refresh(conn.cursor())
+                finally:
+                    conn.close()
+            except Exception as error:
+                sys.stderr.write("Catalog refresh failed: {0}\n".format(error))
+
+        thread = threading.Thread(target=run, name="osql-catalog")
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    def relations(self, kind=None, pattern=None):
+
+        with self._lock:
+            found = list()
+            for (owner, name, object_type) in self.objects.values():
+                if kind is not None and object_type != kind:
+                    continue
+                if pattern is not None and pattern.upper() not in name:
+                    continue
+                found.append((name, owner))
+
+        return sorted(found)
+
+    def names(self):
+
+        with self._lock:
+            names = set(self.objects)
+            names.update(name for (_, name, _) in self.objects.values())
+
+        return names
+
+    def column_names(self):
+
+        with self._lock:
+            names = set()
+            for columns in self.columns.values():
+                names.update(columns)
+
+        return names
+
+    def describe(self, cursor, relation):
+
+        relation = relation.replace(';', '').strip()
+        key = relation.upper()
+
+        with self._lock:
+            if key in self.descriptions:
+                return self.descriptions[key]
+
+        cursor.execute('SELECT * FROM {0} WHERE 1=0'.format(relation))
+
+        # type objects do not survive json, keep their names instead
+        description = list([desc[0], type_name(desc[1])] + list(desc[2:])
+                           for desc in cursor.description)
+
+        with self._lock:
+            self.descriptions[key] = description
+
+        try:
+            self.save_descriptions()
+        except (IOError, OSError) as error:
+            sys.stderr.write("Catalog not saved: {0}\n".format(error))
+
+        return description
@@ -0,0 +1,536 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+
+from export import columns, iter_batches, type_name
+
+try:
+    import numpy
+    import numpy.lib.format
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+"""
+    Columnar Export
+
+    cursor.description is mapped onto typed columns so numbers and dates stay
+    numbers and dates on disk. Rows are fetched in arraysize batches and
+    written as Parquet or Arrow IPC when pyarrow is installed, otherwise as a
+    directory of .npy files (one per column, see NumpyWriter).
+"""
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+FORMAT_NPY = 'npy'
+
+COLUMNAR_FORMATS = [FORMAT_PARQUET, FORMAT_ARROW, FORMAT_NPY]
+
+KIND_INT = 'int64'
+KIND_FLOAT = 'float64'
+KIND_DATETIME = 'datetime'
+KIND_STRING = 'string'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+NAT = -2**63
+
+SCHEMA_FILE = 'schema.json'
+
+try:
+    TEXT_TYPES = (str, unicode)
+    INTEGER_TYPES = (int, long)
+except NameError:
+    TEXT_TYPES = (str, )
+    INTEGER_TYPES = (int, )
+
+
+def default_format():
+
+    if pyarrow is not None:
+        return FORMAT_PARQUET
+    if numpy is not None:
+        return FORMAT_NPY
+
+    raise ImportError("Columnar export needs pyarrow or numpy.")
+
+
+def _infer_kind(values):
+
+    values = list(value for value in values if value is not None)
+
+    if not values:
+        return KIND_STRING
+    if all(isinstance(value, INTEGER_TYPES) and not isinstance(value, bool)
+           for value in values):
+        return KIND_INT
+    if all(isinstance(value, INTEGER_TYPES + (float, )) or
+           hasattr(value, 'as_tuple') for value in values):
+        return KIND_FLOAT
+    if all(isinstance(value, (datetime.datetime, datetime.date))
+           for value in values):
+        return KIND_DATETIME
+
+    return KIND_STRING
+
+
+def from_values(desc):
+
+    """
+        True when the driver's description does not fix the column type: no
+        type code at all (sqlite3), or a plain NUMBER, which cx_Oracle
+        reports with precision 0 and scale -127.
+    """
+
+    if desc[1] is None:
+        return True
+
+    return ('NUMBER' in type_name(desc[1]).upper() and not desc[4] and
+            desc[5] in (None, -127))
+
+
+def column_kind(desc, values):
+
+    """
+        Pick the column type from the driver's type code (cx_Oracle), or from
+        the first batch of values when the driver gives none (sqlite3).
+    """
+
+    if desc[1] is None:
+        return _infer_kind(values)
+
+    name = type_name(desc[1]).upper()
+    (precision, scale) = (desc[4], desc[5])
+
+    if 'DATE' in name or 'TIMESTAMP' in name:
+        return KIND_DATETIME
+    if 'NATIVE_INT' in name or 'BINARY_INTEGER' in name:
+        return KIND_INT
+    if 'NATIVE_FLOAT' in name or 'BINARY_DOUBLE' in name or \
+            'BINARY_FLOAT' in name:
+        return KIND_FLOAT
+    if 'NUMBER' in name:
+        # a plain NUMBER is int64 only while every value seen is an int
+        if from_values(desc):
+            return KIND_INT if _infer_kind(values) == KIND_INT else KIND_FLOAT
+        # NUMBER(p, 0) fits an int64 up to 18 digits
+        if scale == 0 and precision and precision <= 18:
+            return KIND_INT
+        return KIND_FLOAT
+
+    return KIND_STRING
+
+
+def check_kind(col, kind, values):
+
+    """
+        Raise if a batch does not fit a column type that was inferred from an
+        earlier batch, rather than let numpy truncate or mangle it.
+    """
+
+    if kind == KIND_STRING:
+        return
+
+    values = list(value for value in values if value is not None)
+
+    if not values:
+        return
+
+    found = _infer_kind(values)
+
+    if found != kind and not (found == KIND_INT and kind == KIND_FLOAT):
+        raise ValueError("Column {0} was typed {1} from the first batch but "
+                         "later holds {2} values.".format(col, kind, found))
+
+
+def unique_names(cols):
+
+    # SELECT A.ID, B.ID gives two ID columns, files and fields need one each
+    taken = set()
+    names = list()
+
+    for col in cols:
+        name = col
+        suffix = 0
+        while name in taken:
+            suffix += 1
+            name = "{0}_{1}".format(col, suffix)
+        taken.add(name)
+        names.append(name)
+
+    return names
+
+
+def _microseconds(value):
+
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+
+    delta = value.replace(tzinfo=None) - EPOCH
+
+    return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+
+def _text(value):
+
+    if isinstance(value, TEXT_TYPES):
+        return value
+    if hasattr(value, 'read'):
+        return value.read()
+
+    return str(value)
+
+
+class NumpyWriter(object):
+
+    """
+        Writes each column as <name>.npy in a directory. Null flags are
+        kept alongside in <name>.null.npy, strings are stored as
+        utf-8 bytes in <name>.data.npy with int64 end offsets in <name>.npy.
+        Data goes to raw files while streaming and the .npy headers are
+        written once the row count is known.
+    """
+
+    def __init__(self, path, cols, kinds):
+
+        if numpy is None:
+            raise ImportError("The npy format needs numpy.")
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.cols = cols
+        self.kinds = kinds
+        self.rows = 0
+        self._raw = dict()
+        self._string_bytes = dict((col, 0) for col in cols)
+
+        for col, kind in zip(cols, kinds):
+            names = [col, col + '.null']
+            if kind == KIND_STRING:
+                names.append(col + '.data')
+            for name in names:
+                self._raw[name] = open(self._file(name) + '.raw', 'wb')
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def write(self, rows):
+
+        for pos, (col, kind) in enumerate(zip(self.cols, self.kinds)):
+
+            values = list(row[pos] for row in rows)
+            nulls = numpy.array([value is None for value in values],
+                                dtype=numpy.bool_)
+
+            if kind == KIND_INT:
+                data = numpy.array([0 if value is None else value
+                                    for value in values], dtype=numpy.int64)
+            elif kind == KIND_FLOAT:
+                data = numpy.array([numpy.nan if value is None else float(value)
+                                    for value in values], dtype=numpy.float64)
+            elif kind == KIND_DATETIME:
+                data = numpy.array([NAT if value is None else
+                                    _microseconds(value)
+                                    for value in values], dtype=numpy.int64)
+            else:
+                encoded = list(b'' if value is None else
+                               _text(value).encode('utf-8')
+                               for value in values)
+                ends = numpy.cumsum([len(value) for value in encoded],
+                                    dtype=numpy.int64)
+                data = ends + self._string_bytes[col]
+                self._string_bytes[col] += int(ends[-1]) if len(ends) else 0
+                self._raw[col + '.data'].write(b''.join(encoded))
+
+            self._raw[col].write(data.tobytes())
+            self._raw[col + '.null'].write(nulls.tobytes())
+
+        self.rows += len(rows)
+
+    def _finish(self, name, dtype, count):
+
+        raw = self._file(name) + '.raw'
+
+        with open(self._file(name), 'wb') as fd:
+            numpy.lib.format.write_array_header_1_0(fd, {
+                'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)),
+                'fortran_order': False,
+                'shape': (count, ),
+            })
+            with open(raw, 'rb') as data:
+                shutil.copyfileobj(data, fd)
+
+        os.remove(raw)
+
+    def abort(self):
+
+        for name, raw in self._raw.items():
+            raw.close()
+            os.remove(self._file(name) + '.raw')
+
+    def close(self):
+
+        for raw in self._raw.values():
+            raw.close()
+
+        for col, kind in zip(self.cols, self.kinds):
+            dtype = {KIND_FLOAT: numpy.float64}.get(kind, numpy.int64)
+            self._finish(col, dtype, self.rows)
+            self._finish(col + '.null', numpy.bool_, self.rows)
+            if kind == KIND_STRING:
+                self._finish(col + '.data', numpy.uint8,
+                             self._string_bytes[col])
+
+        with open(os.path.join(self.path, SCHEMA_FILE), 'w') as fd:
+            json.dump({'columns': self.cols, 'kinds': self.kinds,
+                       'rows': self.rows}, fd)
+
+
+class ArrowWriter(object):
+
+    ARROW_TYPES = {
+        KIND_INT: 'int64',
+        KIND_FLOAT: 'float64',
+        KIND_STRING: 'string',
+    }
+
+    def __init__(self, path, cols, kinds, fmt=FORMAT_PARQUET):
+
+        if pyarrow is None:
+            raise ImportError("The {0} format needs pyarrow.".format(fmt))
+
+        self.cols = cols
+        self.kinds = kinds
+        self.schema = pyarrow.schema([
+            (col, pyarrow.timestamp('us') if kind == KIND_DATETIME
+             else getattr(pyarrow, ArrowWriter.ARROW_TYPES[kind])())
+            for col, kind in zip(cols, kinds)])
+
+        if fmt == FORMAT_PARQUET:
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+
+        arrays = list()
+
+        for pos, (field, kind) in enumerate(zip(self.schema, self.kinds)):
+            values = list(row[pos] for row in rows)
+            if kind == KIND_FLOAT:
+                values = list(None if value is None else float(value)
+                              for value in values)
+            elif kind == KIND_STRING:
+                values = list(None if value is None else _text(value)
+                              for value in values)
+            elif kind == KIND_DATETIME:
+                values = list(value if value is None or
+                              isinstance(value, datetime.datetime)
+                              else datetime.datetime(value.year, value.month,
+                                                     value.day)
+                              for value in values)
+            arrays.append(pyarrow.array(values, type=field.type))
+
+        self.writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.close()
+
+
+def export_columnar(cursor, path, fmt=None, progress=None, size=None):
+
+    """
+        Stream the rows of an executed cursor into a typed columnar file.
+        Returns the row count.
+    """
+
+    if fmt is None:
+        fmt = default_format()
+
+    cols = unique_names(columns(cursor))
+    # columns the driver does not type are typed from the first batch
+    inferred = list(pos for pos, desc in enumerate(cursor.description)
+                    if from_values(desc))
+    writer = None
+    count = 0
+
+    def open_writer(rows):
+        kinds = list(column_kind(desc, (row[pos] for row in rows))
+                     for pos, desc in enumerate(cursor.description))
+        if fmt == FORMAT_NPY:
+            return NumpyWriter(path, cols, kinds)
+        return ArrowWriter(path, cols, kinds, fmt)
+
+    try:
+        for rows in iter_batches(cursor, size):
+
+            if writer is None:
+                writer = open_writer(rows)
+            else:
+                for pos in inferred:
+                    check_kind(cols[pos], writer.kinds[pos],
+                               (row[pos] for row in rows))
+
+            writer.write(rows)
+            count += len(rows)
+            if progress is not None:
+                progress.update(len(rows))
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    # an empty result still leaves a file with the columns in it
+    if writer is None:
+        writer = open_writer([])
+
+    writer.close()
+
+    if progress is not None:
+        progress.finish()
+
+    return count
+
+
+def load_npy(path):
+
+    """
+        Load a NumpyWriter directory back into a dict of column -> array.
+        Nullable int and datetime columns come back as masked arrays.
+    """
+
+    with open(os.path.join(path, SCHEMA_FILE)) as fd:
+        schema = json.load(fd)
+
+    result = dict()
+
+    for col, kind in zip(schema['columns'], schema['kinds']):
+
+        data = numpy.load(os.path.join(path, col + '.npy'))
+        nulls = numpy.load(os.path.join(path, col + '.null.npy'))
+
+        if kind == KIND_DATETIME:
+            data = data.view('datetime64[us]')
+        elif kind == KIND_STRING:
+            raw = numpy.load(os.path.join(path, col + '.data.npy')).tobytes()
+            starts = numpy.concatenate(([0], data[:-1]))
+            data = numpy.array([raw[start:end].decode('utf-8')
+                                for start, end in zip(starts, data)],
+                               dtype=object)
+
+        if kind != KIND_FLOAT and nulls.any():
+            data = numpy.ma.masked_array(data, mask=nulls)
+
+        result[col] = data
+
+    return result
+
+
+def _size(path):
+
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+
+    return os.path.getsize(path)
+
+
+def benchmark(count, out=None):
+
+    import csv
+    import sqlite3
+    import export
+
+    if out is None:
+        out = sys.stdout
+
+    conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute("CREATE TABLE T (ID INTEGER, AMOUNT REAL, NAME TEXT, "
+                 "CREATED TIMESTAMP)")
+    start = datetime.datetime(2016, 1, 1)
+    conn.executemany("INSERT INTO T VALUES (?, ?, ?, ?)", (
+        (n, n * 1.25, "name-{0}".format(n % 1000),
+         start + datetime.timedelta(seconds=n)) for n in range(count)))
+
+    workdir = tempfile.mkdtemp(prefix="osqlbench")
+    targets = [('csv', os.path.join(workdir, 'out.csv'))]
+    if numpy is not None:
+        targets.append((FORMAT_NPY, os.path.join(workdir, 'out.npy.d')))
+    if pyarrow is not None:
+        targets.append((FORMAT_PARQUET, os.path.join(workdir, 'out.parquet')))
+        targets.append((FORMAT_ARROW, os.path.join(workdir, 'out.arrow')))
+
+    out.write("{0:<8} {1:>10} {2:>10} {3:>12}\n".format(
+        "FORMAT", "EXPORT(s)", "LOAD(s)", "BYTES"))
+
+    for fmt, path in targets:
+
+        cursor = conn.cursor()
+        cursor.arraysize = 10000
+        cursor.execute("SELECT * FROM T")
+
+        begin = time.time()
+        if fmt == 'csv':
+            with export.open_output(path) as fd:
+                export.export_cursor(cursor, fd)
+        else:
+            export_columnar(cursor, path, fmt)
+        exported = time.time() - begin
+
+        # loading means getting typed values back, not just the bytes
+        begin = time.time()
+        if fmt == 'csv':
+            with open(path) as fd:
+                reader = csv.reader(fd)
+                next(reader)
+                for (ident, amount, name, created) in reader:
+                    (int(ident), float(amount), name, datetime.datetime.strptime(
+                        created, "%Y-%m-%d %H:%M:%S"))
+        elif fmt == FORMAT_NPY:
+            load_npy(path)
+        elif fmt == FORMAT_PARQUET:
+            pyarrow.parquet.read_table(path)
+        else:
+            pyarrow.ipc.open_file(path).read_all()
+        loaded = time.time() - begin
+
+        out.write("{0:<8} {1:>10.3f} {2:>10.3f} {3:>12}\n".format(
+            fmt, exported, loaded, _size(path)))
+
+    shutil.rmtree(workdir)
+
+
+_DESCRIPTION = """Columnar Export Benchmark
+    Compare CSV against typed columnar exports of a sqlite3 table.
+"""
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog="columnar.py",
+                                     description=_DESCRIPTION)
+    parser.add_argument("--rows", "-n", type=int, default=200000)
+
+    args = parser.parse_args()
+
+    benchmark(args.rows)
+
+
+if __name__ == "__main__":
+    main()
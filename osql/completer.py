@@ -0,0 +1,211 @@
+import sys
+import time
+import random
+import argparse
+from bisect import bisect_left, insort
+
+"""
+    Tab Completion
+
+    Words are kept as a sorted list of lower cased keys; every word sharing a
+    prefix sits in one contiguous run of that list, so finding the matches
+    for a prefix is two bisects however large the catalog is. Matching is
+    case-insensitive and the word is returned as it was added.
+"""
+
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
+
+
+def _upper_bound(keys, prefix, lo):
+
+    # the first key past every key starting with prefix is the bisect of
+    #  the prefix with its last character bumped by one
+    bump_chr = chr if isinstance(prefix, str) else _unichr
+
+    try:
+        bump = prefix[:-1] + bump_chr(ord(prefix[-1]) + 1)
+    except (ValueError, OverflowError):
+        hi = lo
+        while hi < len(keys) and keys[hi].startswith(prefix):
+            hi += 1
+        return hi
+
+    return bisect_left(keys, bump, lo)
+
+
+class Completer(object):
+
+    # rebuild instead of inserting one by one past this share of new words
+    REBUILD_RATIO = 0.1
+
+    def __init__(self, words=()):
+        self._keys = list()
+        self._words = dict()
+        self.prefix = None
+        self._range = (0, 0)
+        self.replace(words)
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def words(self):
+        return set(self._words.values())
+
+    @words.setter
+    def words(self, words):
+        self.replace(words)
+
+    def replace(self, words):
+
+        lookup = dict((word.lower(), word) for word in words)
+        keys = sorted(lookup)
+
+        # swap both at once, readline may be completing on another thread
+        (self._keys, self._words) = (keys, lookup)
+        self.prefix = None
+
+    def add(self, words):
+
+        new = dict((word.lower(), word) for word in words
+                   if word.lower() not in self._words)
+
+        if len(new) > len(self._keys) * Completer.REBUILD_RATIO:
+            lookup = dict(self._words)
+            lookup.update(new)
+            (self._keys, self._words) = (sorted(lookup), lookup)
+        else:
+            for key, word in new.items():
+                self._words[key] = word
+                insort(self._keys, key)
+
+        self.prefix = None
+
+    def discard(self, words):
+
+        for word in words:
+            key = word.lower()
+            if self._words.pop(key, None) is not None:
+                pos = bisect_left(self._keys, key)
+                del self._keys[pos]
+
+        self.prefix = None
+
+    def matches(self, prefix):
+
+        (lo, hi) = self._find(prefix.lower())
+
+        return list(self._words[key] for key in self._keys[lo:hi])
+
+    def _find(self, prefix):
+
+        keys = self._keys
+        lo = bisect_left(keys, prefix)
+
+        if not prefix:
+            return (lo, len(keys))
+
+        return (lo, _upper_bound(keys, prefix, lo))
+
+    def complete(self, prefix, index):
+        if prefix != self.prefix:
+            # we have a new prefix!
+            # locate the run of keys that start with this prefix
+            self._range = self._find(prefix.lower())
+            self.prefix = prefix
+
+        (lo, hi) = self._range
+
+        if lo + index >= hi:
+            return None
+
+        try:
+            return self._words[self._keys[lo + index]]
+        except (IndexError, KeyError):
+            # the words were updated underneath this prefix
+            return None
+
+
+def synthetic_catalog(count, owners=50, seed=0):
+
+    rng = random.Random(seed)
+    syllables = ['acct', 'addr', 'bill', 'cust', 'dept', 'emp', 'hist', 'inv',
+                 'item', 'ledg', 'log', 'ord', 'pay', 'prod', 'sale', 'ship',
+                 'stg', 'tmp', 'usr', 'vnd']
+    owner_names = list("OWNER{0:03d}".format(n) for n in range(owners))
+
+    names = set()
+
+    while len(names) < count:
+        name = "_".join(rng.choice(syllables)
+                        for _ in range(rng.randint(1, 3))).upper()
+        name += "_{0}".format(rng.randint(0, 9999))
+        names.add("{0}.{1}".format(rng.choice(owner_names), name))
+
+    return names
+
+
+def benchmark(count, lookups=1000, seed=0, out=None):
+
+    if out is None:
+        out = sys.stdout
+
+    names = synthetic_catalog(count, seed=seed)
+    rng = random.Random(seed)
+    sample = list(names)
+
+    start = time.time()
+    completer = Completer(names)
+    out.write("build      {0:>10} names {1:>10.3f}s\n".format(
+        len(completer), time.time() - start))
+
+    prefixes = list()
+    for _ in range(lookups):
+        word = rng.choice(sample).lower()
+        prefixes.append(word[:rng.randint(1, len(word))])
+
+    start = time.time()
+    for prefix in prefixes:
+        completer.complete(prefix, 0)
+        completer.complete(prefix, 1)
+    elapsed = time.time() - start
+    out.write("lookup     {0:>10} prefixes {1:>8.3f}ms each\n".format(
+        lookups, elapsed / lookups * 1000))
+
+    start = time.time()
+    for prefix in prefixes[:10]:
+        [word for word in names if word.startswith(prefix.upper())]
+    elapsed = time.time() - start
+    out.write("linear     {0:>10} prefixes {1:>8.3f}ms each\n".format(
+        10, elapsed / 10 * 1000))
+
+    added = synthetic_catalog(1000, seed=seed + 1)
+    start = time.time()
+    completer.add(added)
+    out.write("add        {0:>10} names {1:>10.3f}s\n".format(
+        len(added), time.time() - start))
+
+
+_DESCRIPTION = """Completer Benchmark
+    Time prefix lookups over a synthetic OWNER.NAME catalog.
+"""
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog="completer.py",
+                                     description=_DESCRIPTION)
+    parser.add_argument("--names", "-n", type=int, default=1000000)
+    parser.add_argument("--lookups", "-l", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    benchmark(args.names, lookups=args.lookups, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import re
+import threading
+
+from jobs import cancel_connection
+
+"""
+    Connection Management
+
+    Nothing connects until a connection is first needed. Long lived sessions
+    are kept per role (metadata lookups, interactive queries) so that a
+    catalog scan or a slow query on one does not hold up the other, while
+    background work such as exports borrows connections from a bounded pool.
+"""
+
+ROLE_METADATA = 'metadata'
+ROLE_QUERY = 'query'
+
+# errors that mean the session is gone rather than that the SQL was bad
+DISCONNECT_CODES = [
+    "ORA-00028",  # your session has been killed
+    "ORA-01012",  # not logged on
+    "ORA-02396",  # exceeded maximum idle time
+    "ORA-03113",  # end-of-file on communication channel
+    "ORA-03114",  # not connected to ORACLE
+    "ORA-03135",  # connection lost contact
+    "DPI-1010",   # not connected
+    "DPI-1080",   # connection was closed
+]
+
+
+RE_READ_ONLY = re.compile(r"^\s*(SELECT|WITH)\b", re.I)
+RE_FOR_UPDATE = re.compile(r"\bFOR\s+UPDATE\b", re.I)
+
+
+def is_disconnect(error):
+
+    message = str(error)
+
+    return any(code in message for code in DISCONNECT_CODES)
+
+
+def is_read_only(sql):
+
+    # plain queries only, SELECT ... FOR UPDATE takes locks
+    return bool(RE_READ_ONLY.match(sql)) and not RE_FOR_UPDATE.search(sql)
+
+
+class PooledConnection(object):
+
+    """
+        Proxy handed out by ConnectionPool; close() returns the connection
+        to the pool instead of logging it off.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def discard(self):
+        self._pool.release(self._conn, discard=True)
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._idle = list()
+        self._busy = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+
+        with self._cond:
+            while not self._idle and self._busy >= self.size:
+                self._cond.wait()
+
+            self._busy += 1
+
+            if self._idle:
+                return PooledConnection(self, self._idle.pop())
+
+        try:
+            # connect outside of the lock, logins can be slow
+            return PooledConnection(self, self.connect())
+        except Exception:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+
+        if discard:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        with self._cond:
+            self._busy -= 1
+            if not discard:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def close(self):
+
+        with self._cond:
+            idle, self._idle = self._idle, list()
+
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class RoleCursor(object):
+
+    """
+        Cursor front for ConnectionManager.execute: every execute gets the
+        role's reconnect and retry, fetches go to the cursor it returned.
+    """
+
+    def __init__(self, manager, role):
+        self._manager = manager
+        self._role = role
+        self._cursor = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, params=None):
+        self._cursor = self._manager.execute(self._role, sql, params)
+        return self
+
+
+class ConnectionManager(object):
+
+    def __init__(self, connect, pool_size=4, arraysize=None):
+        self.connect = connect
+        self.arraysize = arraysize
+        self.pool = ConnectionPool(connect, size=pool_size)
+        self._sessions = dict()
+        self._cursors = dict()
+        self._lock = threading.Lock()
+
+    def session(self, role):
+
+        with self._lock:
+            if role not in self._sessions:
+                self._sessions[role] = self.connect()
+            return self._sessions[role]
+
+    def cursor(self, role):
+
+        conn = self.session(role)
+
+        with self._lock:
+            if role not in self._cursors:
+                cursor = conn.cursor()
+                if self.arraysize is not None:
+                    cursor.arraysize = self.arraysize
+                self._cursors[role] = cursor
+            return self._cursors[role]
+
+    def reset(self, role):
+
+        with self._lock:
+            conn = self._sessions.pop(role, None)
+            self._cursors.pop(role, None)
+
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def execute(self, role, sql, params=None):
+
+        """
+            Execute on the cursor for `role`. A lost session is replaced and
+            a read-only statement retried once on the new one; anything else
+            is raised, whatever the old session had not committed is gone.
+        """
+
+        for attempt in (0, 1):
+            cursor = self.cursor(role)
+            try:
+                if params is None:
+                    cursor.execute(sql)
+                else:
+                    cursor.execute(sql, params)
+                return cursor
+            except Exception as error:
+                if not is_disconnect(error):
+                    raise
+                self.reset(role)
+                if attempt or not is_read_only(sql):
+                    raise
+
+    def role_cursor(self, role):
+        return RoleCursor(self, role)
+
+    def cancel(self, role):
+
+        # whichever session holds the role now, it may have been replaced
+        #  since the statement started
+        with self._lock:
+            conn = self._sessions.get(role)
+
+        return conn is not None and cancel_connection(conn)
+
+    def acquire(self):
+        return self.pool.acquire()
+
+    def close(self):
+
+        for role in list(self._sessions):
+            self.reset(role)
+
+        self.pool.close()
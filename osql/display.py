@@ -0,0 +1,160 @@
+import sys
+import time
+import tabulate as tabulate_module
+from tabulate import tabulate
+
+from export import columns
+
+"""
+    Paged Result Display
+
+    Results are fetched one page at a time and printed as soon as the page
+    arrives; further pages are only fetched when asked for. Column widths are
+    taken from the first page so that every page lines up with the first.
+"""
+
+MORE_PROMPT = "-- more (ENTER next page, q stop) -- "
+
+try:
+    TEXT_TYPES = (str, unicode)
+except NameError:
+    TEXT_TYPES = (str, )
+
+try:
+    read_input = raw_input
+except NameError:
+    read_input = input
+
+
+def _text(value):
+
+    if value is None:
+        return ''
+    if isinstance(value, TEXT_TYPES):
+        return value
+
+    return str(value)
+
+
+class PagedDisplay(object):
+
+    def __init__(self, out=None, page_size=50, limit=None, tablefmt='psql',
+                 extended=False, prompt=None):
+
+        self.out = out if out is not None else sys.stdout
+        self.page_size = page_size
+        self.limit = limit
+        self.tablefmt = tablefmt
+        self.extended = extended
+        self.render_seconds = 0.0
+
+        # only stop between pages when someone is there to continue them
+        if (prompt is None and page_size and self.out.isatty() and
+                sys.stdin.isatty()):
+            prompt = read_input
+        self.prompt = prompt
+
+    def _sample_widths(self, cols, rows):
+
+        widths = [len(_text(col)) for col in cols]
+
+        for row in rows:
+            for pos, value in enumerate(row):
+                widths[pos] = max(widths[pos], len(_text(value)))
+
+        return widths
+
+    def _pad(self, rows, widths):
+
+        padded = list()
+
+        for row in rows:
+            cells = list()
+            for pos, value in enumerate(row):
+                # numbers stay right aligned as tabulate would have done
+                if isinstance(value, (int, float)) or hasattr(value, 'as_tuple'):
+                    cells.append(_text(value).rjust(widths[pos]))
+                else:
+                    cells.append(_text(value).ljust(widths[pos]))
+            padded.append(cells)
+
+        return padded
+
+    def _render(self, cols, rows, widths):
+
+        if self.extended:
+            return "\n".join(tabulate(list(zip(cols, row)),
+                                      ['COLUMN', 'VALUE'], tablefmt='psql')
+                             for row in rows)
+
+        # keep the padding so columns stay as wide as on the first page
+        hold = tabulate_module.PRESERVE_WHITESPACE
+        tabulate_module.PRESERVE_WHITESPACE = True
+
+        try:
+            return tabulate(self._pad(rows, widths), cols,
+                            tablefmt=self.tablefmt, disable_numparse=True)
+        finally:
+            tabulate_module.PRESERVE_WHITESPACE = hold
+
+    def _more(self):
+
+        if self.prompt is None:
+            return True
+
+        try:
+            answer = self.prompt(MORE_PROMPT)
+        except EOFError:
+            return False
+
+        return answer.strip().lower() not in ('q', 'quit')
+
+    def _page(self, cursor, count):
+
+        size = self.page_size or cursor.arraysize
+
+        if self.limit is not None:
+            size = min(size, self.limit - count)
+
+        return size
+
+    def show(self, cursor):
+
+        """
+            Display the rows of an executed cursor. Returns the number of
+            rows shown and whether the result was cut short.
+        """
+
+        cols = columns(cursor)
+        count = 0
+        widths = None
+
+        while True:
+
+            size = self._page(cursor, count)
+            rows = cursor.fetchmany(size)
+
+            if not rows:
+                break
+
+            if widths is None:
+                widths = self._sample_widths(cols, rows)
+
+            start = time.time()
+            self.out.write(self._render(cols, rows, widths))
+            self.out.write("\n")
+            self.out.flush()
+            self.render_seconds += time.time() - start
+            count += len(rows)
+
+            if self.limit is not None and count >= self.limit:
+                return (count, bool(cursor.fetchmany(1)))
+
+            # a short page means the cursor is exhausted
+            if len(rows) < size:
+                break
+
+            if not self._more():
+                return (count, True)
+
+        return (count, False)
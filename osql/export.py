@@ -0,0 +1,479 @@
+import io
+import os
+import sys
+import csv
+import json
+import gzip
+import time
+import shutil
+import threading
+
+from jobs import Cancelled, cancel_connection, POLL_INTERVAL
+
+"""
+    Streaming Result Export
+
+    Rows are pulled from any DB-API cursor with fetchmany(cursor.arraysize)
+    and written as each batch arrives, so memory use is bounded by a single
+    batch no matter how large the result set is.
+"""
+
+FORMAT_CSV = 'csv'
+FORMAT_TSV = 'tsv'
+FORMAT_JSONL = 'jsonl'
+
+STREAM_FORMATS = [FORMAT_CSV, FORMAT_TSV, FORMAT_JSONL]
+
+PY2 = sys.version_info[0] < 3
+
+try:
+    INTEGER_TYPES = (int, long)
+except NameError:
+    INTEGER_TYPES = (int, )
+
+
+def open_output(path, compress=None):
+
+    # compression is inferred from the file name unless asked for explicitly
+    if compress is None:
+        compress = path.endswith('.gz')
+
+    if compress:
+        if PY2:
+            return gzip.open(path, 'wb')
+        return gzip.open(path, 'wt', newline='')
+
+    if PY2:
+        return open(path, 'wb')
+    return io.open(path, 'w', newline='')
+
+
+def iter_batches(cursor, size=None):
+
+    if size is None:
+        size = cursor.arraysize
+
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
+
+
+def columns(cursor):
+    return list([desc[0] for desc in cursor.description])
+
+
+def type_name(value):
+
+    # None stays None, it tells consumers the driver gave no type
+    if value is None:
+        return None
+
+    return getattr(value, '__name__', str(value))
+
+
+class Progress(object):
+
+    def __init__(self, out=None, interval=1.0, quiet=False):
+        self.out = out if out is not None else sys.stderr
+        self.interval = interval
+        # background jobs only count, they are reported through \jobs
+        self.quiet = quiet
+        self.rows = 0
+        self.start = time.time()
+        self._last = self.start
+        self._lock = threading.Lock()
+
+    def rate(self, until=None):
+        elapsed = (until or time.time()) - self.start
+        return self.rows / elapsed if elapsed else 0.0
+
+    def update(self, count):
+
+        # shared by the workers of a parallel export
+        with self._lock:
+            self.rows += count
+            now = time.time()
+
+            if not self.quiet and now - self._last >= self.interval:
+                self._last = now
+                self.out.write("\rROWS {0} ({1:.0f} rows/sec)".format(
+                    self.rows, self.rate()))
+                self.out.flush()
+
+    def finish(self):
+        if self.quiet:
+            return
+        self.out.write("\rROWS {0} ({1:.0f} rows/sec) in {2:.2f}s\n".format(
+            self.rows, self.rate(), time.time() - self.start))
+
+
+def _json_default(value):
+    # dates, decimals and LOBs are written using their string form
+    if hasattr(value, 'read'):
+        return value.read()
+    return str(value)
+
+
+class DelimitedWriter(object):
+
+    def __init__(self, fd, delimiter=','):
+        if delimiter == '\t':
+            self.writer = csv.writer(fd, delimiter='\t',
+                                     quoting=csv.QUOTE_MINIMAL,
+                                     lineterminator='\n')
+        else:
+            self.writer = csv.writer(fd, delimiter=delimiter,
+                                     quotechar='"', quoting=csv.QUOTE_ALL)
+
+    def header(self, cols):
+        self.writer.writerow(cols)
+
+    def rows(self, rows):
+        self.writer.writerows(rows)
+
+
+class JSONLinesWriter(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.cols = None
+
+    def header(self, cols):
+        self.cols = cols
+
+    def rows(self, rows):
+        for row in rows:
+            self.fd.write(json.dumps(dict(zip(self.cols, row)),
+                                     default=_json_default))
+            self.fd.write('\n')
+
+
+def writer_for(fd, fmt):
+
+    if fmt == FORMAT_CSV:
+        return DelimitedWriter(fd, ',')
+    elif fmt == FORMAT_TSV:
+        return DelimitedWriter(fd, '\t')
+    elif fmt == FORMAT_JSONL:
+        return JSONLinesWriter(fd)
+
+    raise ValueError("Unknown export format: {0}".format(fmt))
+
+
+def export_cursor(cursor, fd, fmt=FORMAT_CSV, progress=None, size=None,
+                  header=True, finish=True):
+
+    writer = writer_for(fd, fmt)
+
+    if header:
+        writer.header(columns(cursor))
+    elif fmt == FORMAT_JSONL:
+        # json lines still need the column names for the keys
+        writer.cols = columns(cursor)
+
+    count = 0
+
+    for rows in iter_batches(cursor, size):
+        writer.rows(rows)
+        count += len(rows)
+        if progress is not None:
+            progress.update(len(rows))
+
+    if progress is not None and finish:
+        progress.finish()
+
+    return count
+
+
+def export_query(cursor, sql, path, fmt=FORMAT_CSV, compress=None,
+                 progress=None, params=None):
+
+    if params is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql, params)
+
+    with open_output(path, compress) as fd:
+        return export_cursor(cursor, fd, fmt, progress=progress)
+
+
+"""
+    Parallel Partitioned Export
+
+    The table is split into N disjoint partitions, each partition is read on
+    its own connection and written to its own part file. With ROWID (the
+    default) each partition on Oracle is a set of ROWID ranges covering its
+    share of the table's extents, so every session only reads its own
+    blocks; elsewhere (sqlite) rows are spread by ROWID modulo N. With a
+    numeric key the [MIN, MAX] range of the key is cut into N ranges and rows
+    with a NULL key go to the last one.
+"""
+
+PARTITION_ROWID = 'ROWID'
+
+ORACLE_MODULES = ('cx_Oracle', 'oracledb')
+
+# one (object, first rowid, last rowid) per extent of the table's segments,
+#  in rowid order
+SQL_EXTENTS = """SELECT O.DATA_OBJECT_ID, E.BLOCKS,
+        DBMS_ROWID.ROWID_CREATE(1, O.DATA_OBJECT_ID, E.RELATIVE_FNO,
+                                E.BLOCK_ID, 0),
+        DBMS_ROWID.ROWID_CREATE(1, O.DATA_OBJECT_ID, E.RELATIVE_FNO,
+                                E.BLOCK_ID + E.BLOCKS - 1, 32767)
+    FROM DBA_EXTENTS E JOIN ALL_OBJECTS O
+        ON O.OWNER = E.OWNER AND O.OBJECT_NAME = E.SEGMENT_NAME
+        AND NVL(O.SUBOBJECT_NAME, '-') = NVL(E.PARTITION_NAME, '-')
+    WHERE E.OWNER = NVL(:owner, SYS_CONTEXT('USERENV', 'CURRENT_SCHEMA'))
+        AND E.SEGMENT_NAME = :name
+        AND E.SEGMENT_TYPE LIKE 'TABLE%' AND O.OBJECT_TYPE LIKE 'TABLE%'
+    ORDER BY O.DATA_OBJECT_ID, E.RELATIVE_FNO, E.BLOCK_ID"""
+
+# without access to DBA_EXTENTS the ranges come from one scan of the rowids
+SQL_ROWID_TILES = """SELECT ROWIDTOCHAR(MIN(RID)), ROWIDTOCHAR(MAX(RID))
+    FROM (SELECT ROWID RID, NTILE({0}) OVER (ORDER BY ROWID) NT FROM {1})
+    GROUP BY NT ORDER BY NT"""
+
+ROWID_RANGE = "ROWID BETWEEN CHARTOROWID('{0}') AND CHARTOROWID('{1}')"
+
+
+def is_oracle(cursor):
+    return type(cursor).__module__.split('.')[0] in ORACLE_MODULES
+
+
+def _split_name(table):
+
+    # unquoted names are stored upper case, quoted ones as written
+    parts = list(part[1:-1] if part.startswith('"') else part.upper()
+                 for part in table.strip().split('.'))
+
+    return (None, parts[0]) if len(parts) == 1 else (parts[0], parts[1])
+
+
+def group_extents(extents, parallel):
+
+    """
+        Cut (object id, blocks, first rowid, last rowid) extents, sorted in
+        rowid order, into up to `parallel` groups of about the same number of
+        blocks. Each group is a list of (first rowid, last rowid) ranges, one
+        per object it touches; a range over one object only matches that
+        object's rows, so the blocks of other segments in between are not
+        read twice.
+    """
+
+    total = sum(blocks for (_, blocks, _, _) in extents)
+    groups = list(list() for _ in range(parallel))
+    done = 0
+
+    for (object_id, blocks, low, high) in extents:
+        ranges = groups[min(parallel - 1, done * parallel // total)]
+        if ranges and ranges[-1][0] == object_id:
+            ranges[-1][2] = high
+        else:
+            ranges.append([object_id, low, high])
+        done += blocks
+
+    return list(list((low, high) for (_, low, high) in ranges)
+                for ranges in groups if ranges)
+
+
+def oracle_rowid_partitions(cursor, table, parallel):
+
+    (owner, name) = _split_name(table)
+
+    try:
+        cursor.execute(SQL_EXTENTS, {'owner': owner, 'name': name})
+        groups = group_extents(cursor.fetchall(), parallel)
+    except Exception:
+        # DBA_EXTENTS needs SELECT_CATALOG_ROLE or a direct grant
+        cursor.execute(SQL_ROWID_TILES.format(parallel, table))
+        groups = list([(low, high)] for (low, high) in cursor.fetchall())
+
+    # no extents: an empty table, or not a heap table at all (IOT, view)
+    if not groups:
+        return ["1=1"]
+
+    return list(" OR ".join(ROWID_RANGE.format(low, high)
+                            for (low, high) in ranges)
+                for ranges in groups)
+
+
+def rowid_partitions(cursor, table, parallel):
+
+    if is_oracle(cursor):
+        return oracle_rowid_partitions(cursor, table, parallel)
+
+    # the sqlite stand-in has an integer rowid
+    return list("ROWID % {0} = {1}".format(parallel, part)
+                for part in range(parallel))
+
+
+def _literal(value):
+
+    # repr keeps every digit of a float, but would add an L to a py2 long
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def range_partitions(cursor, table, key, parallel):
+
+    cursor.execute("SELECT MIN({0}), MAX({0}) FROM {1}".format(key, table))
+    (low, high) = cursor.fetchone()
+
+    if low is None or parallel == 1:
+        return ["1=1"]
+
+    # integer keys are cut exactly, anything else (Decimal, float) as float
+    if isinstance(low, INTEGER_TYPES) and isinstance(high, INTEGER_TYPES):
+        span = high - low + 1
+        bounds = [low + span * part // parallel for part in range(parallel)]
+    else:
+        (low, high) = (float(low), float(high))
+        step = (high - low) / parallel
+        bounds = [low + step * part for part in range(parallel)]
+
+    # the outer partitions are left open so that no rounding of MIN or MAX
+    #  can drop a row, and the inner bounds use the same literal on each side
+    predicates = ["{0} < {1}".format(key, _literal(bounds[1]))]
+
+    for part in range(1, parallel - 1):
+        predicates.append("{0} >= {1} AND {0} < {2}".format(
+            key, _literal(bounds[part]), _literal(bounds[part + 1])))
+
+    predicates.append("{0} >= {1} OR {0} IS NULL".format(
+        key, _literal(bounds[-1])))
+
+    return predicates
+
+
+def partition_predicates(cursor, table, parallel, key=None):
+
+    if parallel < 1:
+        raise ValueError("parallel must be at least 1")
+
+    if key is None or key.upper() == PARTITION_ROWID:
+        return rowid_partitions(cursor, table, parallel)
+
+    return range_partitions(cursor, table, key, parallel)
+
+
+def part_path(path, part):
+
+    # keep the compression suffix last so it is still inferred per part
+    if path.endswith('.gz'):
+        return "{0}.part{1:03d}.gz".format(path[:-3], part)
+
+    return "{0}.part{1:03d}".format(path, part)
+
+
+def _export_partition(connect, sql, path, fmt, arraysize, header, progress,
+                      opened):
+
+    conn = connect()
+    # listed while in use so that a Ctrl-C can cancel it
+    opened.append(conn)
+
+    try:
+        cursor = conn.cursor()
+        cursor.arraysize = arraysize
+        if hasattr(cursor, 'prefetchrows'):
+            cursor.prefetchrows = arraysize + 1
+        cursor.execute(sql)
+
+        with open_output(path) as fd:
+            return export_cursor(cursor, fd, fmt, progress=progress,
+                                 header=header, finish=False)
+    finally:
+        opened.remove(conn)
+        conn.close()
+
+
+def merge_parts(paths, path):
+
+    # gzip members may be concatenated, so parts are merged byte for byte
+    with open(path, 'wb') as out:
+        for part in paths:
+            with open(part, 'rb') as fd:
+                shutil.copyfileobj(fd, out)
+            os.remove(part)
+
+
+def export_table(connect, table, path, parallel=1, fmt=FORMAT_CSV, key=None,
+                 merge=False, arraysize=50000, progress=None, where=None,
+                 cancelled=None):
+
+    """
+        Export a table over `parallel` connections obtained from `connect`.
+        Returns the list of files written and the total row count. Setting
+        the `cancelled` event from another thread stops it like Ctrl-C.
+    """
+
+    conn = connect()
+
+    try:
+        predicates = partition_predicates(conn.cursor(), table, parallel, key)
+    finally:
+        conn.close()
+
+    # a single partition is written straight to `path`
+    if len(predicates) == 1:
+        paths = [path]
+    else:
+        paths = list(part_path(path, part) for part in range(len(predicates)))
+
+    counts = [0] * len(predicates)
+    errors = list()
+    opened = list()
+    if cancelled is None:
+        cancelled = threading.Event()
+
+    def run(part):
+        sql = "SELECT * FROM {0} WHERE ({1})".format(table, predicates[part])
+        if where:
+            sql += " AND ({0})".format(where)
+        try:
+            # a merged export only keeps the header of the first part
+            header = part == 0 or not merge
+            if not cancelled.is_set():
+                counts[part] = _export_partition(
+                    connect, sql, paths[part], fmt, arraysize, header,
+                    progress, opened)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = list(threading.Thread(target=run, args=(part, ))
+                   for part in range(len(predicates)))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            # join with a timeout so KeyboardInterrupt reaches this thread
+            while thread.is_alive() and not cancelled.is_set():
+                thread.join(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        cancelled.set()
+
+    if cancelled.is_set():
+        for conn in list(opened):
+            cancel_connection(conn)
+        for thread in threads:
+            thread.join()
+        for part in paths:
+            if os.path.exists(part):
+                os.remove(part)
+        raise Cancelled()
+
+    if progress is not None:
+        progress.finish()
+
+    if errors:
+        (_, error, _) = errors[0]
+        raise error
+
+    if merge and len(paths) > 1:
+        merge_parts(paths, path)
+        paths = [path]
+
+    return (paths, sum(counts))
@@ -0,0 +1,200 @@
+import time
+import threading
+
+"""
+    Cancellable and Background Work
+
+    Statements run on a worker thread while the REPL thread waits on it, so a
+    Ctrl-C at the prompt only breaks the statement (through the driver's
+    cancel call) instead of the whole session. Longer work such as exports can
+    be left running as a job.
+"""
+
+POLL_INTERVAL = 0.1
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class Cancelled(Exception):
+    pass
+
+
+def cancel_connection(conn):
+
+    """
+        Break the call in flight on `conn`: cx_Oracle exposes this as
+        cancel(), sqlite3 as interrupt().
+    """
+
+    for name in ('cancel', 'interrupt'):
+        if hasattr(conn, name):
+            getattr(conn, name)()
+            return True
+
+    return False
+
+
+def run_cancellable(cancel, fn, *args, **kwargs):
+
+    """
+        Run fn on a worker thread; on Ctrl-C call `cancel` to break the
+        statement in flight and raise Cancelled once the worker returns.
+    """
+
+    result = dict()
+
+    def run():
+        try:
+            result['value'] = fn(*args, **kwargs)
+        except BaseException as error:
+            result['error'] = error
+
+    worker = threading.Thread(target=run, name="osql-query")
+    worker.daemon = True
+    worker.start()
+
+    cancelled = False
+
+    while worker.is_alive():
+        try:
+            # join with a timeout so KeyboardInterrupt reaches this thread
+            worker.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            if not cancelled:
+                cancel()
+                cancelled = True
+
+    if cancelled:
+        raise Cancelled()
+
+    if 'error' in result:
+        raise result['error']
+
+    return result['value']
+
+
+class CancellableCursor(object):
+
+    """
+        Cursor proxy that runs each execute and fetch through
+        run_cancellable, so Ctrl-C also breaks a slow fetch.
+    """
+
+    def __init__(self, cursor, cancel):
+        self._cursor = cursor
+        self._cancel = cancel
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def execute(self, *args):
+        run_cancellable(self._cancel, self._cursor.execute, *args)
+        return self
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return run_cancellable(self._cancel, self._cursor.fetchmany)
+        return run_cancellable(self._cancel, self._cursor.fetchmany, size)
+
+    def fetchone(self):
+        return run_cancellable(self._cancel, self._cursor.fetchone)
+
+    def fetchall(self):
+        return run_cancellable(self._cancel, self._cursor.fetchall)
+
+
+class Job(object):
+
+    def __init__(self, id, description, progress=None, cancel=None):
+        self.id = id
+        self.description = description
+        self.progress = progress
+        self._cancel = cancel
+        self.status = STATUS_RUNNING
+        self.started = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.thread = None
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def rows(self):
+        return self.progress.rows if self.progress is not None else None
+
+    def cancel(self):
+        if self._cancel is None:
+            return False
+        self._cancel()
+        return True
+
+    def rate(self):
+        # a finished job keeps the rate it ended with
+        if self.progress is None:
+            return None
+        return self.progress.rate(until=self.finished)
+
+
+class JobManager(object):
+
+    def __init__(self):
+        self.jobs = list()
+        self._ids = 0
+        self._lock = threading.Lock()
+
+    def start(self, description, fn, progress=None, cancel=None):
+
+        with self._lock:
+            self._ids += 1
+            job = Job(self._ids, description, progress, cancel)
+            self.jobs.append(job)
+
+        def run():
+            try:
+                job.result = fn()
+                job.status = STATUS_DONE
+            except Exception as error:
+                job.error = error
+                job.status = STATUS_FAILED
+            job.finished = time.time()
+
+        job.thread = threading.Thread(target=run,
+                                      name="osql-job-{0}".format(job.id))
+        job.thread.daemon = True
+        job.thread.start()
+
+        return job
+
+    def running(self):
+        return list(job for job in self.jobs if job.status == STATUS_RUNNING)
+
+    def wait(self, jobs=None):
+
+        # join with a timeout so KeyboardInterrupt still reaches the caller
+        for job in (self.running() if jobs is None else jobs):
+            while job.thread.is_alive():
+                job.thread.join(POLL_INTERVAL)
+
+    def rows(self):
+
+        rows = list()
+
+        for job in self.jobs:
+            rate = job.rate()
+            rows.append((job.id, job.status, job.rows(),
+                         None if rate is None else int(rate),
+                         round(job.elapsed(), 1),
+                         job.error if job.error else job.description))
+
+        return rows
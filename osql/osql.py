@@ -1,22 +1,45 @@
 import os
 import re
 import sys
+import time
+import pickle
+import threading
 import cx_Oracle
 from tabulate import tabulate
 import readline
-import csv
+import argparse
+
+import export
+import columnar
+from display import PagedDisplay
+from connection import ConnectionManager, ROLE_METADATA, ROLE_QUERY
+from catalog import Catalog, TYPE_TABLE, TYPE_VIEW
+from completer import Completer
+from jobs import JobManager, Cancelled, CancellableCursor, run_cancellable
+from stats import StatementStats, InstrumentedCursor, ServerStats, StatsLog
+from cache import ResultCache, RecordingCursor, normalize, is_cacheable
 
 CMD_QUIT = 'q'
 
 CMD_SAVE_NEXT = 'sn'
 CMD_SAVE_PREV = 'sp'
 
+CMD_EXPORT = 'export'
+CMD_BACKGROUND = 'bg'
+CMD_LIST_JOBS = 'jobs'
+
 CMD_LIST_VIEWS = 'dv'
 CMD_LIST_TABLES = 'dt'
+CMD_REFRESH_CATALOG = 'refresh'
 
 CMD_SET_SAVE_FORMAT = 'sf'
 CMD_SET_OUTPUT_FORMAT = 'of'
 CMD_SET_EXTENDED = 'x'
+CMD_SET_LIMIT = 'limit'
+CMD_SET_PAGE = 'page'
+CMD_SET_TIMING = 'timing'
+CMD_SET_STATS = 'stats'
+CMD_CACHE = 'cache'
 
 # Output Data
 
@@ -40,26 +63,6 @@ hist_fd = open(HISTORY_FILE, 'a')
 hist_fd.close()
 
 
-class Completer:
-
-    def __init__(self, words):
-        self.words = words
-        self.prefix = None
-
-    def complete(self, prefix, index):
-        if prefix != self.prefix:
-            # we have a new prefix!
-            # find all words that start with this prefix
-            self.matching_words = [
-                word for word in self.words if word.startswith(prefix)
-                ]
-            self.prefix = prefix
-        try:
-            return self.matching_words[index]
-        except IndexError:
-            return None
-
-
 service_name = ""
 hostname = ""
 port = ""
@@ -91,58 +94,161 @@ connection_str = "{user}/{passwd}@{tnsname}".format(user=username,
                                                     passwd=password,
                                                     tnsname=tnsname)
 
-conn = cx_Oracle.connect(connection_str)
-cursor = conn.cursor()
+# nothing connects until the first statement or catalog lookup needs it
+sessions = ConnectionManager(lambda: cx_Oracle.connect(connection_str),
+                             pool_size=8, arraysize=10000)
+
+# the password is left out of the key, it does not change the schema
+connection_key = "{user}@{tnsname}".format(user=username, tnsname=tnsname)
+catalog = Catalog(connection_key)
+
+jobs = JobManager()
+server_stats = ServerStats()
+result_cache = ResultCache(namespace=connection_key)
+
+# (normalized sql, CachedCursor) of the last fully fetched result, for \sp
+last_result = None
 
 RE_COMMAND = re.compile(r"^\\(?P<command>.*)")
 
 var_extended = False
 var_save_format = 'csv'
 var_output_format = 'psql'
+var_row_limit = 10000
+var_page_size = 50
+var_timing = False
+var_stats_log = None
+var_cache = False
 
 
 def shutdown():
+
+    # jobs run on daemon threads, leaving now would cut their output short
+    running = jobs.running()
+    if running:
+        sys.stdout.write("\n{0} background job(s) still running.\n".format(
+            len(running)))
+        try:
+            answer = raw_input("Wait for them to finish? [Y/n] ")
+        except EOFError:
+            # nobody left to answer, so do not drop the exports
+            answer = 'y'
+        except KeyboardInterrupt:
+            answer = 'n'
+        try:
+            if answer.strip().lower() in ('', 'y', 'yes'):
+                jobs.wait(running)
+        except KeyboardInterrupt:
+            pass
+        # a cancelled export removes its partial files before it returns
+        for job in jobs.running():
+            if job.cancel():
+                sys.stderr.write("\n[{0}] cancelled: {1}".format(
+                    job.id, job.description))
+        try:
+            jobs.wait()
+        except KeyboardInterrupt:
+            pass
+
     readline.write_history_file(HISTORY_FILE)
+    sessions.close()
     sys.stdout.write('\n')
     sys.exit(0)
 
 
-def save_query_results(cursor, sql, path, fmt='csv'):
+def save_query_results(cursor, sql, path, fmt=None, result=None):
 
-    try:
-        with open(path, 'w') as fd:
+    if fmt is None:
+        fmt = var_save_format
 
-            queries = list(x for x in sql.split(';') if bool(x.strip()))
+    try:
+        queries = list(x for x in sql.split(';') if bool(x.strip()))
 
-            if len(queries) > 1:
-                sys.stderr.write("Query Saver will only save the first query submitted.")
+        if len(queries) > 1:
+            sys.stderr.write("Query Saver will only save the first query submitted.")
 
-            sql = queries.pop()
+        sql = queries.pop()
 
+        # an already fetched result is saved without asking the server again
+        if result is not None:
+            cursor = result
+        else:
             cursor.execute(sql)
-            cols = list([desc[0] for desc in cursor.description])
-            rows = cursor.fetchall()
 
-            global var_save_format
-            if var_save_format == 'csv':
+        if fmt in export.STREAM_FORMATS:
+            with export.open_output(path) as fd:
+                export.export_cursor(cursor, fd, fmt,
+                                     progress=export.Progress(sys.stderr))
+        elif fmt in columnar.COLUMNAR_FORMATS:
+            columnar.export_columnar(cursor, path, fmt,
+                                     progress=export.Progress(sys.stderr))
+        else:
+            # tabulate needs every row up front to size the columns
+            with export.open_output(path) as fd:
+                cols = export.columns(cursor)
+                rows = cursor.fetchall()
+                fd.write(tabulate(rows, cols, tablefmt=fmt))
+
+    except (ImportError, ValueError) as error:
+        sys.stderr.write("{0}\n".format(error))
+    except OSError:
+        print "?"
 
-                writer = csv.writer(fd, delimiter=',',
-                                    quotechar='"', quoting=csv.QUOTE_ALL)
 
-                writer.writerow(cols)
-                writer.writerows(rows)
-            else:
-                fd.write(tabulate(rows, cols, tablefmt=var_save_format))
+def export_table(args, background=False):
 
-    except OSError:
-        print "?"
+    parser = argparse.ArgumentParser(prog="\\export", add_help=False)
+    parser.add_argument("table")
+    parser.add_argument("path")
+    parser.add_argument("--parallel", "-p", type=int, default=1)
+    parser.add_argument("--key", "-k", default=export.PARTITION_ROWID,
+                        help="ROWID or a numeric column to range partition")
+    parser.add_argument("--merge", "-m", action="store_true")
+    parser.add_argument("--format", "-f", default=None,
+                        choices=export.STREAM_FORMATS)
+    parser.add_argument("--where", "-w", default=None)
+
+    try:
+        opts = parser.parse_args(args)
+        if opts.parallel < 1:
+            raise SystemExit(2)
+    except SystemExit:
+        sys.stderr.write("usage: \\export TABLE PATH [--parallel N] "
+                         "[--key COL] [--merge] [--format FMT] "
+                         "[--where EXPR]\n")
+        return
+
+    fmt = opts.format
+    if fmt is None:
+        fmt = var_save_format if var_save_format in export.STREAM_FORMATS else 'csv'
+
+    progress = export.Progress(sys.stderr, quiet=background)
+    cancelled = threading.Event()
+
+    def run():
+        return export.export_table(
+            sessions.acquire, opts.table, opts.path,
+            parallel=opts.parallel, fmt=fmt, key=opts.key, merge=opts.merge,
+            progress=progress, where=opts.where, cancelled=cancelled)
+
+    if background:
+        job = jobs.start("export {0} {1}".format(opts.table, opts.path), run,
+                         progress=progress, cancel=cancelled.set)
+        sys.stdout.write("[{0}] started\n".format(job.id))
+        return
+
+    try:
+        (paths, count) = run()
+    except (cx_Oracle.DatabaseError, ValueError, IOError, OSError) as error:
+        sys.stderr.write("Export failed: {0}\n".format(error))
+        return
 
+    for path in paths:
+        sys.stdout.write("{0}\n".format(path))
 
 
 def describe(cursor, relation):
-    relation = relation.replace(';', '').strip()
-    cursor.execute('SELECT * FROM {0} WHERE 1=0'.format(relation))
-    return cursor.description
+    return catalog.describe(cursor, relation)
 
 
 def remove_last_history_item():
@@ -150,7 +256,114 @@ def remove_last_history_item():
     readline.remove_history_item(last)
 
 
-def run_command(command, cursor):
+def update_completions(catalog):
+    completer.replace(catalog.names() | catalog.column_names())
+
+
+def cancellable_cursor(role):
+    return CancellableCursor(sessions.role_cursor(role),
+                             lambda: sessions.cancel(role))
+
+
+def ensure_catalog():
+
+    # only the very first run has to wait for the catalog
+    if not catalog.is_loaded():
+        catalog.refresh(cancellable_cursor(ROLE_METADATA))
+
+
+def remember_result(query, result, cacheable):
+
+    global last_result
+
+    if result is None:
+        return
+
+    last_result = (normalize(query), result)
+
+    if cacheable:
+        try:
+            result_cache.put(query, result)
+        except (pickle.PicklingError, TypeError, IOError, OSError) as error:
+            # LOBs and other live driver objects cannot be stored
+            sys.stderr.write("Result not cached: {0}\n".format(error))
+
+
+def previous_result(sql):
+
+    if last_result is not None and last_result[0] == normalize(sql):
+        return last_result[1].rewind()
+
+    if var_cache and is_cacheable(sql):
+        return result_cache.get(sql)
+
+    return None
+
+
+def run_query(query):
+
+    global last_result
+
+    # a cancelled or partly shown run must not leave an older result for \sp
+    last_result = None
+
+    cacheable = var_cache and is_cacheable(query)
+    cursor = result_cache.get(query) if cacheable else None
+    # a hit is not written back, that would push its expiry out again
+    store = cacheable and cursor is None
+
+    # a cache hit only needs the session when server stats are sampled
+    stats = None
+    if var_timing or var_stats_log is not None:
+        stats = StatementStats(query)
+        before = server_stats.sample(sessions.session(ROLE_QUERY))
+
+    def cancel():
+        return sessions.cancel(ROLE_QUERY)
+
+    start = time.time()
+    if cursor is not None:
+        sys.stdout.write("(cached result)\n")
+    else:
+        cursor = run_cancellable(cancel, sessions.execute, ROLE_QUERY, query)
+        # on Oracle a filtered scan spends most of its time in the first fetch
+        cursor = CancellableCursor(cursor, cancel)
+
+    if stats is not None:
+        stats.execute_seconds = time.time() - start
+        cursor = InstrumentedCursor(cursor, stats)
+
+    if cursor.description:
+        display = PagedDisplay(page_size=var_page_size, limit=var_row_limit,
+                               tablefmt=var_output_format,
+                               extended=var_extended)
+        recorder = RecordingCursor(cursor)
+        try:
+            (count, more) = display.show(recorder)
+        except KeyboardInterrupt:
+            sessions.cancel(ROLE_QUERY)
+            raise Cancelled()
+        print("ROWS {0}{1}".format(
+            count, " (more rows not shown)" if more else ""))
+        if not more:
+            remember_result(query, recorder.result(), store)
+    else:
+        display = None
+        print("ROWS {0}".format(cursor.rowcount))
+
+    if stats is not None:
+        if display is not None:
+            stats.render_seconds = display.render_seconds
+        # the sampling query adds one round trip of its own to the delta
+        conn = sessions.session(ROLE_QUERY)
+        stats.server = server_stats.delta(before, server_stats.sample(conn))
+        if var_timing:
+            print(stats.report())
+        if var_stats_log is not None:
+            var_stats_log.write(stats)
+
+
+def run_command(command, sessions):
 
     args = command.strip().split()
 
@@ -165,7 +378,9 @@ def run_command(command, cursor):
         sys.stderr.write('NOT IMPLEMENTED\n')
     elif command == CMD_SET_SAVE_FORMAT:
 
-        if len(args) and args[0].lower() in (VALID_OUTPUT_FORMATS + ['csv']):
+        if len(args) and args[0].lower() in (VALID_OUTPUT_FORMATS +
+                                             export.STREAM_FORMATS +
+                                             columnar.COLUMNAR_FORMATS):
             global var_save_format
             var_save_format = args[0].lower()
             sys.stdout.write("SAVE_FORMAT = {0}\n".format(var_save_format))
@@ -177,6 +392,73 @@ def run_command(command, cursor):
             var_output_format = args[0].lower()
             sys.stdout.write("OUTPUT_FORMAT = {0}\n".format(var_output_format))
 
+    elif command == CMD_SET_LIMIT:
+
+        # \limit off (or 0) removes the cap on displayed rows
+        if len(args):
+            global var_row_limit
+            value = args[0].lower()
+            if value in ('off', '0'):
+                var_row_limit = None
+            elif value.isdigit():
+                var_row_limit = int(value) or None
+            else:
+                sys.stderr.write("usage: \\limit N|off\n")
+        sys.stdout.write("ROW_LIMIT = {0}\n".format(var_row_limit or 'off'))
+
+    elif command == CMD_SET_PAGE:
+
+        # \page off (or 0) prints every page without stopping
+        if len(args):
+            global var_page_size
+            value = args[0].lower()
+            if value in ('off', '0'):
+                var_page_size = None
+            elif value.isdigit():
+                var_page_size = int(value) or None
+            else:
+                sys.stderr.write("usage: \\page N|off\n")
+        sys.stdout.write("PAGE_SIZE = {0}\n".format(var_page_size or 'off'))
+
+    elif command == CMD_SET_TIMING:
+        global var_timing
+        var_timing = bool(len(args) and args[0].lower() == 'on')
+        sys.stdout.write("TIMING = {0}\n".format('on' if var_timing else 'off'))
+
+    elif command == CMD_SET_STATS:
+
+        # \stats PATH appends one JSON line per statement, \stats off stops
+        global var_stats_log
+        if len(args) and args[0].lower() != 'off':
+            var_stats_log = StatsLog(' '.join(args))
+        else:
+            var_stats_log = None
+        sys.stdout.write("STATS = {0}\n".format(
+            var_stats_log.path if var_stats_log else 'off'))
+
+    elif command == CMD_CACHE:
+
+        # \cache on|off|clear, \cache ttl SECONDS, \cache size MB
+        global var_cache
+        option = args[0].lower() if len(args) else None
+
+        if option in ('on', 'off'):
+            var_cache = option == 'on'
+        elif option == 'clear':
+            result_cache.clear()
+        elif option == 'ttl' and len(args) > 1 and args[1].isdigit():
+            result_cache.ttl = int(args[1])
+        elif option == 'size' and len(args) > 1 and args[1].isdigit():
+            result_cache.max_bytes = int(args[1]) * 2**20
+            result_cache.evict()
+        elif option is not None:
+            sys.stderr.write("usage: \\cache on|off|clear|ttl SECONDS|"
+                             "size MB\n")
+
+        sys.stdout.write("CACHE = {0} (ttl {1}s, {2}/{3} bytes)\n".format(
+            'on' if var_cache else 'off', result_cache.ttl,
+            result_cache.size(), result_cache.max_bytes))
+
     elif command == CMD_SAVE_PREV:
 
         path = '/tmp/osql_save'
@@ -189,41 +471,55 @@ def run_command(command, cursor):
 
         print sql
 
-        save_query_results(cursor, sql, path)
-
+        save_query_results(cancellable_cursor(ROLE_QUERY), sql, path,
+                           result=previous_result(sql))
+
+    elif command == CMD_EXPORT:
+        export_table(args)
+    elif command == CMD_BACKGROUND:
+        # \bg takes the same arguments as \export
+        export_table(args, background=True)
+    elif command == CMD_LIST_JOBS:
+        print tabulate(jobs.rows(), ['Job', 'Status', 'Rows', 'Rows/sec',
+                                     'Elapsed', 'Description'],
+                       tablefmt='psql')
     elif command == CMD_LIST_TABLES:
-        cursor.execute("SELECT TABLE_NAME, OWNER FROM ALL_TABLES")
-        rows = cursor.fetchall()
+        ensure_catalog()
+        rows = catalog.relations(TYPE_TABLE)
         print tabulate(rows, ['Name', 'Owner'], tablefmt='psql')
     elif command == CMD_LIST_VIEWS:
-        SQL = "SELECT VIEW_NAME, OWNER FROM ALL_VIEWS"
-        if len(args):
-            SQL += " WHERE VIEW_NAME LIKE '%{0}%'".format(args[0])
-        cursor.execute(SQL)
-        rows = cursor.fetchall()
+        ensure_catalog()
+        rows = catalog.relations(TYPE_VIEW,
+                                 pattern=args[0] if len(args) else None)
         if len(rows) > 1:
             print tabulate(rows, ['Name', 'Owner'], tablefmt='psql')
         else:
+            cursor = cancellable_cursor(ROLE_METADATA)
             print tabulate(describe(cursor, args[0]),
                            ['name', 'type', 'display_size', 'internal_size',
                             'precision', 'scale', 'null_ok'], tablefmt='psql')
+    elif command == CMD_REFRESH_CATALOG:
+        # \refresh full rescans, otherwise only changed objects are fetched
+        full = bool(len(args) and args[0].lower() == 'full')
+        catalog.refresh(cancellable_cursor(ROLE_METADATA), full=full)
+        sys.stdout.write("CATALOG {0} objects\n".format(len(catalog.objects)))
     else:
         sys.stderr.write("Unknown command.\n")
 
 try:
     readline.read_history_file(HISTORY_FILE)
-    cursor.execute("SELECT TABLE_NAME FROM ALL_TABLES UNION SELECT VIEW_NAME FROM ALL_VIEWS")
 
-    words = set()
-    for (name, ) in cursor:
-        words.add(name)
-
-    completer = Completer(words)
+    # completions come from the cached catalog straight away and are
+    #  updated once the background refresh has caught up with the server
+    completer = Completer(set())
+    catalog.listeners.append(update_completions)
+    if catalog.load():
+        update_completions(catalog)
+    catalog.refresh_in_background(sessions.acquire)
 
     readline.parse_and_bind("tab: complete")
     readline.set_completer(completer.complete)
 
-    cursor.arraysize = 10000
     while True:
 
         data = raw_input("SQL> ")
@@ -231,7 +527,12 @@ try:
         command = RE_COMMAND.match(data)
 
         if command:
-            run_command(command.group('command'), cursor)
+            try:
+                run_command(command.group('command'), sessions)
+            except (Cancelled, KeyboardInterrupt):
+                sys.stdout.write("\nCancelled.\n")
+            except cx_Oracle.DatabaseError as error:
+                print error
 
         # ENTER SQL MODE
         else:
@@ -240,7 +541,8 @@ try:
                 while ';' not in data:
                     remove_last_history_item()
                     data += " " + raw_input("  -> ")
-            except KeyboardError:
+            except KeyboardInterrupt:
+                sys.stdout.write('\n')
                 continue
 
             try:
@@ -249,16 +551,9 @@ try:
                 for query in queries:
                     if bool(query.strip()):
                         readline.add_history(query + ';')
-                        cursor.execute(query)
-                        rows = cursor.fetchall()
-                        if cursor.rowcount:
-                            cols = list([desc[0] for desc in cursor.description])
-                            if var_extended:
-                                for row in rows:
-                                    print tabulate(zip(cols, row), ['COLUMN', 'VALUE'], tablefmt='psql')
-                            else:
-                                print tabulate(rows, cols, tablefmt=var_output_format)
-                        print("ROWS {0}".format(cursor.rowcount))
+                        run_query(query)
+            except (Cancelled, KeyboardInterrupt):
+                sys.stdout.write("\nCancelled.\n")
             except cx_Oracle.DatabaseError as error:
                 print error
 except EOFError:
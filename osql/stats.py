@@ -0,0 +1,223 @@
+import json
+import time
+
+"""
+    Statement Instrumentation
+
+    Splits the time spent on a statement into execute, fetch and render and
+    counts fetch calls, rows and bytes on the client. When the session may
+    read V$MYSTAT the server's own counters (round trips, bytes sent, logical
+    reads, CPU) are sampled before and after the statement as well.
+"""
+
+SERVER_STATS = [
+    'SQL*Net roundtrips to/from client',
+    'bytes sent via SQL*Net to client',
+    'session logical reads',
+    'physical reads',
+    'CPU used by this session',
+]
+
+SQL_SERVER_STATS = """SELECT N.NAME, S.VALUE
+    FROM V$MYSTAT S JOIN V$STATNAME N ON S.STATISTIC# = N.STATISTIC#
+    WHERE N.NAME IN ({0})""".format(
+    ", ".join("'{0}'".format(name) for name in SERVER_STATS))
+
+
+try:
+    TEXT_TYPE = unicode
+except NameError:
+    TEXT_TYPE = str
+
+
+def _value_size(value, size=None):
+
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, TEXT_TYPE):
+        return len(value.encode('utf-8'))
+
+    # numbers and dates count at the column's internal size rather than
+    #  being formatted a second time
+    if size:
+        return size
+
+    return len(str(value))
+
+
+def _column_sizes(description):
+
+    sizes = list()
+
+    for desc in description or ():
+        size = desc[3] if len(desc) > 3 else None
+        sizes.append(size if isinstance(size, int) and size > 0 else None)
+
+    return sizes
+
+
+class StatementStats(object):
+
+    def __init__(self, sql):
+        self.sql = sql.strip()
+        self.started = time.time()
+        self.execute_seconds = 0.0
+        self.first_row_seconds = None
+        self.fetch_seconds = 0.0
+        self.fetch_calls = 0
+        self.rows = 0
+        self.bytes = 0
+        self.render_seconds = 0.0
+        self.server = dict()
+
+    def rows_per_sec(self):
+        elapsed = self.execute_seconds + self.fetch_seconds
+        return self.rows / elapsed if elapsed else 0.0
+
+    def to_dict(self):
+        return {
+            'sql': self.sql,
+            'started': self.started,
+            'execute_seconds': self.execute_seconds,
+            'first_row_seconds': self.first_row_seconds,
+            'fetch_seconds': self.fetch_seconds,
+            'fetch_calls': self.fetch_calls,
+            'rows': self.rows,
+            'rows_per_sec': self.rows_per_sec(),
+            'bytes': self.bytes,
+            'render_seconds': self.render_seconds,
+            'server': self.server,
+        }
+
+    def report(self):
+
+        lines = list()
+        lines.append("execute {0:.3f}s".format(self.execute_seconds))
+
+        if self.first_row_seconds is not None:
+            lines.append("first row {0:.3f}s".format(self.first_row_seconds))
+
+        lines.append("fetch {0:.3f}s in {1} calls".format(
+            self.fetch_seconds, self.fetch_calls))
+        lines.append("{0} rows ({1:.0f} rows/sec)".format(
+            self.rows, self.rows_per_sec()))
+        lines.append("{0} bytes".format(self.bytes))
+        lines.append("render {0:.3f}s".format(self.render_seconds))
+
+        if 'SQL*Net roundtrips to/from client' in self.server:
+            lines.append("{0} round trips".format(
+                self.server['SQL*Net roundtrips to/from client']))
+
+        return "TIMING " + ", ".join(lines)
+
+
+class InstrumentedCursor(object):
+
+    """
+        Cursor proxy that times and counts fetches into a StatementStats.
+    """
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._sizes = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def _record(self, start, rows):
+
+        stats = self._stats
+        elapsed = time.time() - start
+
+        stats.fetch_seconds += elapsed
+        stats.fetch_calls += 1
+
+        if rows and stats.first_row_seconds is None:
+            stats.first_row_seconds = stats.execute_seconds + elapsed
+
+        if self._sizes is None:
+            self._sizes = _column_sizes(self._cursor.description)
+
+        stats.rows += len(rows)
+        stats.bytes += sum(_value_size(value, size) for row in rows
+                           for (value, size) in zip(row, self._sizes))
+
+    def fetchmany(self, size=None):
+
+        start = time.time()
+        if size is None:
+            rows = self._cursor.fetchmany()
+        else:
+            rows = self._cursor.fetchmany(size)
+        self._record(start, rows)
+
+        return rows
+
+    def fetchone(self):
+
+        start = time.time()
+        row = self._cursor.fetchone()
+        self._record(start, [row] if row is not None else [])
+
+        return row
+
+    def fetchall(self):
+
+        start = time.time()
+        rows = self._cursor.fetchall()
+        self._record(start, rows)
+
+        return rows
+
+
+class ServerStats(object):
+
+    """
+        Samples V$MYSTAT on the statement's own session. Sampling is turned
+        off for good the first time the view cannot be read.
+    """
+
+    def __init__(self):
+        self.available = True
+
+    def sample(self, conn):
+
+        if not self.available:
+            return dict()
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute(SQL_SERVER_STATS)
+            values = dict(cursor.fetchall())
+            cursor.close()
+        except Exception:
+            self.available = False
+            return dict()
+
+        return values
+
+    def delta(self, before, after):
+        return dict((name, after[name] - before.get(name, 0))
+                    for name in after)
+
+
+class StatsLog(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, stats):
+        with open(self.path, 'a') as fd:
+            fd.write(json.dumps(stats.to_dict(), sort_keys=True))
+            fd.write("\n")